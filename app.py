@@ -1,8 +1,197 @@
+import os
+import re
+import sys
+import shutil
+import json
+import hashlib
+import time
+import bisect
+import random
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
 import anthropic
 import plotly.express as px
+import plotly.graph_objects as go
+import plotly.io as pio
+import requests
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
 from datetime import datetime
+try:
+    import fcntl
+except ImportError:
+    # Windows: ingestion is then only serialized within one process
+    fcntl = None
+
+# Source workbook and the directory holding derived snapshots/indexes
+DATA_FILE = "main usa food recall.xlsx"
+CACHE_DIR = ".contamio_cache"
+# Bump whenever the snapshot layout changes so old snapshots get rebuilt
+SNAPSHOT_FORMAT = 4
+
+# Text columns stored as categoricals when their values repeat enough
+CATEGORICAL_COLUMNS = ["Food Category", "Recall Category", "Detailed Recall Category", "Month Name",
+                       "Season", "Company Size", "Status", "Recalling Firm Name", "Classification"]
+DATE_COLUMNS = ["Center Classification Date", "Recall Initiation Date", "Report Date", "Termination Date"]
+# Columns behind the sidebar multiselects
+FILTER_COLUMNS = ["Year", "Month Name", "Food Category", "Recall Category", "Detailed Recall Category"]
+# Dimensions of the pre-aggregated count cube behind the dashboard charts
+CUBE_DIMENSIONS = ["Year", "Month Name", "Recall Category", "Food Category", "Season", "Company Size"]
+# Columns outside the cube that the dashboard still counts per slice
+CUBE_ROW_COLUMNS = ["Recalling Firm Name", "Detailed Recall Category"]
+MAX_CUBE_CELLS = 20_000_000
+# New recall batches (xlsx, CSV or openFDA JSON) dropped here are appended as partitions of the dataset
+INCOMING_DIR = "incoming"
+INCOMING_EXTENSIONS = (".xlsx", ".csv", ".json")
+PARTITIONS_DIR = os.path.join(CACHE_DIR, "partitions")
+INGEST_POLL_SECONDS = 10
+# openFDA food enforcement fields and the workbook columns they fill
+OPENFDA_COLUMNS = {
+    "recall_number": "Recall Number",
+    "recalling_firm": "Recalling Firm Name",
+    "product_description": "Product Description",
+    "reason_for_recall": "Reason for Recall",
+    "classification": "Classification",
+    "status": "Status",
+    "distribution_pattern": "Distribution Pattern",
+    "center_classification_date": "Center Classification Date",
+    "recall_initiation_date": "Recall Initiation Date",
+    "report_date": "Report Date",
+    "termination_date": "Termination Date"
+}
+# Column ordering the Recent Recalls table and its page sizes
+RECENCY_COLUMN = "Center Classification Date"
+RECENT_PAGE_SIZES = [25, 50, 100]
+# Persistent cache of Claude responses
+LLM_MODEL = "claude-3-7-sonnet-20250219"
+LLM_MAX_OUTPUT_TOKENS = 1500
+# Token budgets: total input per request, any single message, and verbatim chat history
+MAX_INPUT_TOKENS = 12000
+MAX_MESSAGE_TOKENS = 2000
+HISTORY_TOKEN_BUDGET = 4000
+# Older chat turns are folded into a rolling memory by a smaller model
+SUMMARY_MODEL = "claude-3-5-haiku-20241022"
+SUMMARY_MAX_TOKENS = 400
+# query_claude reports failures as text starting with one of these
+QUERY_ERROR_PREFIXES = ("API Error:", "Error:", "API key not found", "You've reached the maximum usage limit")
+# Pricing per million tokens by model; prompt cache writes cost 1.25x input, reads 0.1x
+MODEL_PRICES = {
+    LLM_MODEL: {"input": 3.00, "output": 15.00, "cache_write": 3.75, "cache_read": 0.30},
+    SUMMARY_MODEL: {"input": 0.80, "output": 4.00, "cache_write": 1.00, "cache_read": 0.08}
+}
+LLM_CACHE_PATH = os.path.join(CACHE_DIR, "llm_responses.sqlite")
+LLM_CACHE_TTL_SECONDS = 24 * 3600
+LLM_CACHE_MAX_ENTRIES = 5000
+LLM_CACHE_MAX_BYTES = 50 * 1024 * 1024
+# HTTP client defaults for the Messages API; each can be overridden in secrets or the environment
+LLM_BASE_URL = "https://api.anthropic.com"
+LLM_CONNECT_TIMEOUT = 5.0
+LLM_READ_TIMEOUT = 120.0
+LLM_MAX_RETRIES = 4
+LLM_BACKOFF_SECONDS = 0.5
+LLM_BACKOFF_MAX_SECONDS = 30.0
+LLM_POOL_SIZE = 16
+LLM_RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+# Chat turns kept in session memory; older, already summarized turns move to a per-session store
+CHAT_MAX_MESSAGES_IN_MEMORY = 40
+CHAT_LOAD_PAGE_SIZE = 20
+# Stored turns loaded back into the transcript are bounded too
+CHAT_MAX_EARLIER_MESSAGES = 100
+CHAT_STORE_PATH = os.path.join(CACHE_DIR, "chat_history.sqlite")
+CHAT_STORE_TTL_SECONDS = 7 * 24 * 3600
+# Local query tool the chat model can call for exact figures
+LLM_MAX_TOOL_ROUNDS = 4
+TOOL_FILTER_COLUMNS = ["Year", "Month Name", "Season", "Food Category", "Recall Category", "Detailed Recall Category",
+                       "Classification", "Status", "Company Size"]
+TOOL_GROUP_COLUMNS = TOOL_FILTER_COLUMNS + ["Recalling Firm Name", "State"]
+TOOL_MAX_ROWS = 25
+TOOL_ENUM_MAX_VALUES = 60
+TOOL_CACHE_MAX_ENTRIES = 1024
+TOOL_CACHE_MAX_BYTES = 16 * 1024 * 1024
+# Insight types offered in the Insights tab, all precomputed in the background
+INSIGHT_ASPECTS = {
+    "Overall Analysis": "overall",
+    "Recall Trends": "trends",
+    "Allergen Analysis": "allergens",
+    "Contaminant Analysis": "contaminants",
+    "Economic Impact": "economic"
+}
+INSIGHTS_WORKERS = len(INSIGHT_ASPECTS)
+# Failed insights are retried in the background after a delay that doubles with each consecutive failure
+INSIGHTS_RETRY_SECONDS = 30
+INSIGHTS_RETRY_MAX_SECONDS = 15 * 60
+# Local BM25 retrieval over recall records for grounding chat answers
+RETRIEVAL_COLUMNS = ["Product Description", "Reason for Recall", "Recalling Firm Name", "Food Category",
+                     "Recall Category", "Detailed Recall Category", "Classification", "Distribution Pattern",
+                     "Year", "Month Name", "Season"]
+RETRIEVAL_TOP_K = 8
+RETRIEVAL_AGGREGATE_POOL = 200
+RETRIEVAL_MAX_TOKENS = 1500
+BM25_K1 = 1.2
+BM25_B = 0.75
+RETRIEVAL_STOPWORDS = {"a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "how", "in", "is", "it", "many",
+                       "of", "on", "or", "that", "the", "to", "was", "were", "what", "which", "with", "any", "there"}
+# Spike and trend detection over the monthly Recall Category x Food Category series
+TREND_BASELINE_MONTHS = 12
+TREND_MIN_BASELINE_MONTHS = 6
+TREND_Z_THRESHOLD = 3.0
+# A spike also needs at least this many recalls and this multiple of its baseline
+TREND_MIN_COUNT = 5
+TREND_MIN_RATIO = 2.0
+TREND_SHIFT_MONTHS = 6
+TREND_SHIFT_THRESHOLD = 3.0
+TREND_SLOPE_MONTHS = 24
+TREND_MAX_ANOMALIES = 15
+# Columns covered by the "Search recalls" box
+SEARCH_COLUMNS = ["Product Description", "Recalling Firm Name", "Reason for Recall"]
+
+MONTH_ORDER = {
+    "January": 1, "February": 2, "March": 3, "April": 4,
+    "May": 5, "June": 6, "July": 7, "August": 8,
+    "September": 9, "October": 10, "November": 11, "December": 12
+}
+SEASON_ORDER = {"Winter": 1, "Spring": 2, "Summer": 3, "Fall": 4}
+MONTH_NAMES = list(MONTH_ORDER)
+SEASON_NAMES = list(SEASON_ORDER)
+# Index into SEASON_NAMES for each month ordinal (slot 0 unused)
+MONTH_SEASONS = np.array([-1, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3, 0], dtype=np.int8)
+
+# US states plus DC and territories, one bit each in the "State Mask" column (must stay within 64)
+US_STATES = [
+    ("AL", "Alabama"), ("AK", "Alaska"), ("AZ", "Arizona"), ("AR", "Arkansas"), ("CA", "California"),
+    ("CO", "Colorado"), ("CT", "Connecticut"), ("DE", "Delaware"), ("FL", "Florida"), ("GA", "Georgia"),
+    ("HI", "Hawaii"), ("ID", "Idaho"), ("IL", "Illinois"), ("IN", "Indiana"), ("IA", "Iowa"),
+    ("KS", "Kansas"), ("KY", "Kentucky"), ("LA", "Louisiana"), ("ME", "Maine"), ("MD", "Maryland"),
+    ("MA", "Massachusetts"), ("MI", "Michigan"), ("MN", "Minnesota"), ("MS", "Mississippi"), ("MO", "Missouri"),
+    ("MT", "Montana"), ("NE", "Nebraska"), ("NV", "Nevada"), ("NH", "New Hampshire"), ("NJ", "New Jersey"),
+    ("NM", "New Mexico"), ("NY", "New York"), ("NC", "North Carolina"), ("ND", "North Dakota"), ("OH", "Ohio"),
+    ("OK", "Oklahoma"), ("OR", "Oregon"), ("PA", "Pennsylvania"), ("RI", "Rhode Island"), ("SC", "South Carolina"),
+    ("SD", "South Dakota"), ("TN", "Tennessee"), ("TX", "Texas"), ("UT", "Utah"), ("VT", "Vermont"),
+    ("VA", "Virginia"), ("WA", "Washington"), ("WV", "West Virginia"), ("WI", "Wisconsin"), ("WY", "Wyoming"),
+    ("DC", "District of Columbia"), ("PR", "Puerto Rico"), ("VI", "Virgin Islands"), ("GU", "Guam")
+]
+# Abbreviations that are also English words only count when they appear in a list (next to , ; / or parentheses)
+AMBIGUOUS_STATE_CODES = {"AL", "DE", "HI", "ID", "IN", "LA", "MA", "ME", "OH", "OK", "OR", "PA"}
+# "Nationwide" covers the 50 states and DC
+NATIONWIDE_MASK = np.uint64((1 << 51) - 1)
+NATIONWIDE_PATTERN = r"\bnation\s*-?\s*wide\b|\bnationally\b|\ball (?:50 )?states\b|\bthroughout the (?:us|u\.s\.|usa|united states)\b"
+
+# Bounds for the shared dashboard aggregation cache
+AGGREGATE_CACHE_MAX_ENTRIES = 512
+AGGREGATE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Bounds of the shared cache of built dashboard figures
+FIGURE_CACHE_MAX_ENTRIES = 512
+FIGURE_CACHE_MAX_BYTES = 64 * 1024 * 1024
 
     # interactive plotly charts
 def plotly_chart(fig, key=None, use_container_width=True):
@@ -19,6 +208,13 @@ def plotly_chart(fig, key=None, use_container_width=True):
     
     return None
     
+# Function to rerun only the calling fragment, or the whole app when the fragment ran as part of a full run
+def rerun_fragment():
+    try:
+        st.rerun(scope="fragment")
+    except st.errors.StreamlitAPIException:
+        st.rerun()
+
 # Set page configuration
 st.set_page_config(
     page_title="Contamio Food Recall Analysis",
@@ -132,45 +328,1998 @@ def display_logo():
         </div>
     </div>
     ''', unsafe_allow_html=True)
+# Function to fingerprint the source workbook by mtime, size and content hash
+def file_fingerprint(path, previous=None):
+    stat = os.stat(path)
+    # Unchanged mtime and size: trust the hash recorded last time instead of re-reading the file
+    if previous and previous.get("mtime_ns") == stat.st_mtime_ns and previous.get("size") == stat.st_size:
+        return previous
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha256": digest.hexdigest()}
+
+# Function to make object columns storable in Arrow (Excel columns often mix numbers and text)
+def arrow_safe(df):
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True).startswith("mixed"):
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+# Function to normalize column types: categoricals, a small integer Year and real datetimes
+def normalize_schema(df, max_unique_ratio=0.5):
+    df = df.copy()
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns and df[col].dtype == object:
+            if df[col].nunique() <= max(1, len(df) * max_unique_ratio):
+                df[col] = df[col].astype("category")
+    if "Year" in df.columns:
+        years = pd.to_numeric(df["Year"], errors="coerce")
+        if years.dropna().mod(1).eq(0).all():
+            df["Year"] = years.astype("Int16")
+        else:
+            df["Year"] = years
+    for col in DATE_COLUMNS:
+        if col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = pd.to_datetime(df[col], errors="coerce")
+    return df
+
+# Function to count values of a possibly categorical column, leaving out unused categories
+def observed_counts(series):
+    counts = series.value_counts()
+    return counts[counts > 0]
+
+# Function to build the regular expressions that detect one state in a distribution pattern
+def state_patterns(abbr, name):
+    if abbr in AMBIGUOUS_STATE_CODES:
+        abbr_pattern = rf"(?:^|[,;/(]\s*){abbr}\b|\b{abbr}(?=\s*(?:[,;/)]|$))"
+    else:
+        abbr_pattern = rf"\b{abbr}\b"
+    name_pattern = rf"\b{name.lower()}\b"
+    if abbr == "VA":
+        name_pattern = r"(?<!west )\bvirginia\b"
+    elif abbr == "WA":
+        name_pattern = r"\bwashington\b(?!,?\s*d\.?\s?c\b)"
+    elif abbr == "DC":
+        name_pattern = r"\bdistrict of columbia\b|\bwashington,?\s*d\.?\s?c\b"
+    return abbr_pattern, name_pattern
+
+# Function to parse distribution patterns into one 64-bit state membership mask per record
+def parse_state_masks(patterns):
+    # Parse each distinct pattern once, then broadcast back to the rows
+    codes, uniques = pd.factorize(patterns.astype(object).where(patterns.notna(), None))
+    text = pd.Series(uniques, dtype=object).astype(str)
+    lower = text.str.lower()
+    masks = np.zeros(len(text), dtype=np.uint64)
+    for bit, (abbr, name) in enumerate(US_STATES):
+        abbr_pattern, name_pattern = state_patterns(abbr, name)
+        found = text.str.contains(abbr_pattern, regex=True) | lower.str.contains(name_pattern, regex=True)
+        masks[found.to_numpy()] |= np.uint64(1 << bit)
+    masks[lower.str.contains(NATIONWIDE_PATTERN, regex=True).to_numpy()] |= NATIONWIDE_MASK
+    return np.where(codes >= 0, masks[np.maximum(codes, 0)], np.uint64(0)).astype(np.uint64)
+
+# Function to count the distinct states covered by a set of state masks
+def count_states(masks):
+    if len(masks) == 0:
+        return 0
+    return bin(int(np.bitwise_or.reduce(masks))).count("1")
+
+# Function to count records per state for a set of state masks
+def state_counts(masks):
+    counts = {abbr: int(np.count_nonzero(masks & np.uint64(1 << bit))) for bit, (abbr, _) in enumerate(US_STATES)}
+    return pd.Series(counts, name="Count").loc[lambda c: c > 0].sort_values(ascending=False)
+
+# Function to derive the calendar columns from the classification date in one vectorized pass: Year, Month
+# (1-12), Month Name and Season as ordered categoricals, and Period (months since year 0) for grouping on integers.
+# Rows without a date keep what the spreadsheet says
+def derive_calendar_columns(df):
+    df = df.copy()
+    missing = np.full(len(df), np.nan)
+    if RECENCY_COLUMN in df.columns:
+        dates = pd.to_datetime(df[RECENCY_COLUMN], errors="coerce")
+        years = dates.dt.year.to_numpy(dtype=float)
+        months = dates.dt.month.to_numpy(dtype=float)
+    else:
+        years, months = missing, missing.copy()
+    if "Year" in df.columns:
+        years = np.where(np.isnan(years), pd.to_numeric(df["Year"], errors="coerce").to_numpy(dtype=float), years)
+    if "Month Name" in df.columns:
+        stated = pd.Series(df["Month Name"].astype(object)).map(MONTH_ORDER).to_numpy(dtype=float)
+        months = np.where(np.isnan(months), stated, months)
+    seasons = np.full(len(df), -1, dtype=np.int8)
+    if "Season" in df.columns:
+        seasons = pd.Categorical(df["Season"].astype(object), categories=SEASON_NAMES).codes.astype(np.int8)
+
+    has_month = ~np.isnan(months)
+    month_codes = np.where(has_month, months - 1, -1).astype(np.int8)
+    df["Year"] = pd.array(np.where(np.isnan(years), None, years), dtype="Int16")
+    df["Month"] = pd.array(np.where(has_month, months, None), dtype="Int8")
+    df["Month Name"] = pd.Categorical.from_codes(month_codes, categories=MONTH_NAMES, ordered=True)
+    df["Season"] = pd.Categorical.from_codes(np.where(has_month, MONTH_SEASONS[month_codes + 1], seasons),
+                                             categories=SEASON_NAMES, ordered=True)
+    periods = years * 12 + months - 1
+    df["Period"] = pd.array(np.where(np.isnan(periods), None, periods), dtype="Int32")
+    return df
+
+# Function to turn a Period key array into the first day of each month, without building strings
+def period_dates(periods):
+    return (np.asarray(periods, dtype=np.int64) - 1970 * 12).astype("datetime64[M]").astype("datetime64[ns]")
+
+# Function to turn a raw workbook frame into the typed frame stored in the snapshot
+def prepare_frame(df):
+    df = normalize_schema(derive_calendar_columns(arrow_safe(df)))
+    if "Distribution Pattern" in df.columns:
+        df["State Mask"] = parse_state_masks(df["Distribution Pattern"])
+    return df
+
+# Function to work out the dataset version of the workbook, returning it with its fingerprint and the manifest
+def source_version(source=DATA_FILE, cache_dir=CACHE_DIR):
+    manifest_path = os.path.join(cache_dir, "snapshot.json")
+    manifest = {}
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+
+    previous = manifest.get("source") if manifest.get("format") == SNAPSHOT_FORMAT else None
+    fingerprint = file_fingerprint(source, previous)
+    return f"{fingerprint['sha256'][:16]}-v{SNAPSHOT_FORMAT}", fingerprint, manifest
+
+# Function to convert the workbook into a columnar snapshot once and memory-map it afterwards
+def load_snapshot(source=DATA_FILE, cache_dir=CACHE_DIR):
+    manifest_path = os.path.join(cache_dir, "snapshot.json")
+    version, fingerprint, manifest = source_version(source, cache_dir)
+    snapshot_path = os.path.join(cache_dir, f"recalls-{version}.feather")
+
+    if os.path.exists(snapshot_path):
+        df = feather.read_table(snapshot_path, memory_map=True).to_pandas()
+    else:
+        df = prepare_frame(pd.read_excel(source))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write uncompressed so later loads can memory-map the file directly
+            tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+            feather.write_feather(df, tmp_path, compression="uncompressed")
+            os.replace(tmp_path, snapshot_path)
+            # Drop snapshots of older workbook versions
+            for name in os.listdir(cache_dir):
+                if name.startswith("recalls-") and name.endswith(".feather") and name != os.path.basename(snapshot_path):
+                    os.remove(os.path.join(cache_dir, name))
+        except OSError as e:
+            print(f"Could not write data snapshot: {e}")
+
+    if manifest.get("source") != fingerprint or manifest.get("format") != SNAPSHOT_FORMAT:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(manifest_path, "w") as f:
+                json.dump({"format": SNAPSHOT_FORMAT, "source": fingerprint, "version": version}, f)
+        except OSError as e:
+            print(f"Could not write snapshot manifest: {e}")
+
+    df.attrs["dataset_version"] = version
+    return df
+
+# Function to read one incoming recall file into a frame with the workbook's column names
+def read_recall_file(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".xlsx":
+        return pd.read_excel(path)
+    if extension == ".csv":
+        return pd.read_csv(path)
+    if extension == ".json":
+        with open(path) as f:
+            payload = json.load(f)
+        # openFDA dumps wrap the records in "results"; a bare list of records works too
+        records = payload.get("results", []) if isinstance(payload, dict) else payload
+        df = pd.DataFrame.from_records(records).rename(columns=OPENFDA_COLUMNS)
+        df = df[[col for col in OPENFDA_COLUMNS.values() if col in df.columns]]
+        for col in DATE_COLUMNS:
+            if col in df.columns:
+                # openFDA dates are YYYYMMDD strings
+                df[col] = pd.to_datetime(df[col].astype(str), format="%Y%m%d", errors="coerce")
+        return df
+    raise ValueError(f"Unsupported recall file type: {extension}")
+
+# Function to read the partitions manifest file as stored, whatever its format
+def read_manifest_file(partitions_dir=PARTITIONS_DIR):
+    try:
+        with open(os.path.join(partitions_dir, "manifest.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Function to read the partitions manifest: the partitions in append order and the files already ingested
+def read_partitions_manifest(partitions_dir=PARTITIONS_DIR):
+    manifest = read_manifest_file(partitions_dir)
+    # Partitions written in an older snapshot layout are ingested again from their source files
+    if manifest.get("format") != SNAPSHOT_FORMAT:
+        return {"format": SNAPSHOT_FORMAT, "partitions": [], "sources": {}}
+    return manifest
+
+# Function to write the partitions manifest atomically
+def write_partitions_manifest(manifest, partitions_dir=PARTITIONS_DIR):
+    path = os.path.join(partitions_dir, "manifest.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+# Serializes ingestion between the sessions of this process
+INGEST_LOCK = threading.Lock()
+
+# Function to hold the ingestion lock: the thread lock within this process and a lock file across processes
+@contextmanager
+def partitions_lock(partitions_dir=PARTITIONS_DIR):
+    with INGEST_LOCK:
+        os.makedirs(partitions_dir, exist_ok=True)
+        with open(os.path.join(partitions_dir, "manifest.lock"), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# Function to write new recall files from the incoming directory as partitions, keeping only unseen recall numbers.
+# Returns the manifest entries of the partitions written
+def ingest_incoming(known_numbers, incoming_dir=INCOMING_DIR, partitions_dir=PARTITIONS_DIR):
+    if not os.path.isdir(incoming_dir):
+        return []
+    # The whole read-modify-write of the manifest, partition files included, happens under the lock
+    with partitions_lock(partitions_dir):
+        stored = read_manifest_file(partitions_dir)
+        manifest = read_partitions_manifest(partitions_dir)
+        original = json.dumps(manifest, sort_keys=True)
+        sources = manifest["sources"]
+        ingested = {entry["sha256"] for entry in sources.values()}
+        known = set(known_numbers)
+        # Recall numbers already written by other processes but not yet applied by the caller
+        for entry in manifest["partitions"]:
+            known.update(entry.get("recall_numbers", []))
+        added = []
+        for name in sorted(os.listdir(incoming_dir)):
+            path = os.path.join(incoming_dir, name)
+            if not name.lower().endswith(INCOMING_EXTENSIONS) or not os.path.isfile(path):
+                continue
+            previous = sources.get(name)
+            fingerprint = file_fingerprint(path, previous)
+            if fingerprint == previous:
+                continue
+            if fingerprint["sha256"] in ingested:
+                # Same content under a new name or a touched file: nothing new to read
+                sources[name] = {**fingerprint, "rows": 0}
+                continue
+            try:
+                batch = read_recall_file(path)
+            except Exception as e:
+                print(f"Could not ingest {name}: {e}")
+                sources[name] = {**fingerprint, "rows": 0, "error": str(e)}
+                continue
+            if "Recall Number" in batch.columns:
+                numbers = batch["Recall Number"].where(batch["Recall Number"].isna(), batch["Recall Number"].astype(str))
+                # Keep the first copy of each recall number, and drop those the dataset already has
+                batch = batch[~(numbers.isin(known) | (numbers.notna() & numbers.duplicated()))]
+                new_numbers = batch["Recall Number"].dropna().astype(str).tolist()
+            else:
+                new_numbers = []
+            if len(batch):
+                file_name = f"part-{len(manifest['partitions']) + 1:05d}-{fingerprint['sha256'][:12]}.feather"
+                tmp_path = os.path.join(partitions_dir, f"{file_name}.{os.getpid()}.tmp")
+                feather.write_feather(prepare_frame(batch.reset_index(drop=True)), tmp_path, compression="uncompressed")
+                os.replace(tmp_path, os.path.join(partitions_dir, file_name))
+                entry = {"file": file_name, "source": name, "rows": len(batch), "recall_numbers": new_numbers}
+                manifest["partitions"].append(entry)
+                added.append(entry)
+                known.update(new_numbers)
+            sources[name] = {**fingerprint, "rows": len(batch)}
+            ingested.add(fingerprint["sha256"])
+        if json.dumps(manifest, sort_keys=True) != original:
+            write_partitions_manifest(manifest, partitions_dir)
+            # Drop the files of an older-format manifest this one replaced, unless a new partition reused the name
+            if stored.get("format") != SNAPSHOT_FORMAT:
+                listed = {entry["file"] for entry in manifest["partitions"]}
+                for entry in stored.get("partitions", []):
+                    path = os.path.join(partitions_dir, entry["file"])
+                    if entry["file"] not in listed and os.path.exists(path):
+                        os.remove(path)
+        return added
+
+# Function to derive the dataset version from the workbook version and the partitions appended to it
+def partitioned_version(base_version, partition_files):
+    if not partition_files:
+        return base_version
+    digest = hashlib.sha256("\n".join(partition_files).encode()).hexdigest()[:8]
+    return f"{base_version}+{len(partition_files)}-{digest}"
+
+# Function to append prepared rows to the frame, keeping its dtypes and widening categoricals by the new values
+def append_rows(df, rows):
+    df = df.copy(deep=False)
+    rows = rows.reindex(columns=df.columns)
+    if "State Mask" in rows.columns:
+        rows["State Mask"] = rows["State Mask"].fillna(0)
+    for col in df.columns:
+        dtype = df[col].dtype
+        if isinstance(dtype, pd.CategoricalDtype) and dtype.ordered:
+            # Calendar categoricals already list every possible value
+            rows[col] = pd.Categorical(rows[col].astype(object), categories=dtype.categories, ordered=True)
+        elif isinstance(dtype, pd.CategoricalDtype):
+            # Union keeps the categories sorted, matching a snapshot categorized from scratch
+            categories = dtype.categories.union(pd.Index(rows[col].dropna().astype(object).unique()))
+            df[col] = df[col].cat.set_categories(categories)
+            rows[col] = pd.Categorical(rows[col].astype(object), categories=categories)
+        else:
+            try:
+                rows[col] = rows[col].astype(dtype)
+            except (TypeError, ValueError):
+                pass
+    combined = pd.concat([df, rows], ignore_index=True)
+    combined.attrs = dict(df.attrs)
+    return combined
+
+# Function to merge a column's labels with the values of appended rows, in the order pd.factorize(sort=True) gives
+def merged_labels(labels, values):
+    merged = set(labels) | set(pd.unique(values.dropna()).tolist())
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return [value for value in values.cat.categories.tolist() if value in merged]
+    return sorted(merged)
+
+# Bitsets of row positions for every distinct value of the filter columns
+class FilterIndex:
+    def __init__(self, df, columns=FILTER_COLUMNS):
+        self.size = len(df)
+        self.bitsets = {}
+        for col in columns:
+            if col not in df.columns:
+                continue
+            codes, uniques = pd.factorize(df[col], sort=True)
+            self.bitsets[col] = {
+                value: np.packbits(codes == code)
+                for code, value in enumerate(uniques.tolist())
+            }
+
+    def values(self, col):
+        return list(self.bitsets.get(col, {}))
+
+    # OR the bitsets of the selected values within a column, AND across columns
+    def select(self, filters):
+        result = None
+        for col, selected in filters.items():
+            if not selected or col not in self.bitsets:
+                continue
+            column_bits = self.bitsets[col]
+            union = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+            for value in selected:
+                bits = column_bits.get(value)
+                if bits is not None:
+                    np.bitwise_or(union, bits, out=union)
+            if result is None:
+                result = union
+            else:
+                np.bitwise_and(result, union, out=result)
+        if result is None:
+            return np.arange(self.size)
+        return np.flatnonzero(np.unpackbits(result, count=self.size))
+
+    # A copy covering the rows appended from position start on, without re-reading the existing rows
+    def extended(self, df, start):
+        index = FilterIndex.__new__(FilterIndex)
+        index.size = len(df)
+        index.bitsets = {}
+        for col, column_bits in self.bitsets.items():
+            new_rows = df[col].iloc[start:]
+            index.bitsets[col] = {}
+            for value in merged_labels(list(column_bits), new_rows):
+                old_bits = column_bits.get(value)
+                old_rows = np.unpackbits(old_bits, count=start) if old_bits is not None else np.zeros(start, dtype=np.uint8)
+                index.bitsets[col][value] = np.packbits(np.concatenate([old_rows, (new_rows == value).to_numpy(dtype=bool, na_value=False)]))
+        return index
+
+# Function to pack trigrams, given as arrays of their first, second and third code points, into integer keys.
+# Code points fit in 21 bits, so the keys sort like the trigrams
+def trigram_keys(first, second, third):
+    return (first.astype(np.uint64) << np.uint64(42)) | (second.astype(np.uint64) << np.uint64(21)) | third.astype(np.uint64)
+
+# Function to build the trigram posting lists of the documents: the sorted distinct keys, and for each key the
+# ascending document ids doc_ids[starts[i]:starts[i + 1]]. Documents are joined with NUL separators and processed
+# in chunks; within a chunk every (trigram, document) pair is packed into one integer over the chunk's alphabet,
+# so a single sort orders and deduplicates the pairs
+def trigram_postings(docs, first_id=0, chunk_size=20000):
+    keys, doc_ids = [], []
+    start = 0
+    while start < len(docs):
+        chunk = docs[start:start + chunk_size]
+        codes = np.frombuffer("\0".join(chunk).encode("utf-32-le"), dtype=np.uint32)
+        alphabet = np.unique(codes)
+        size = len(alphabet)
+        if size ** 3 * len(chunk) >= 2 ** 63:
+            chunk_size = max(1, chunk_size // 2)
+            continue
+        if len(codes) >= 3:
+            lengths = np.fromiter(map(len, chunk), dtype=np.int64, count=len(chunk))
+            owner = np.repeat(np.arange(len(chunk), dtype=np.int64), lengths + 1)[:len(codes) - 2]
+            # Trigrams crossing a separator belong to no document
+            valid = (codes[:-2] != 0) & (codes[1:-1] != 0) & (codes[2:] != 0)
+            dense = np.searchsorted(alphabet, codes).astype(np.int64)
+            grams = (dense[:-2] * size + dense[1:-1]) * size + dense[2:]
+            packed = np.unique(grams[valid] * len(chunk) + owner[valid])
+            grams = packed // len(chunk)
+            keys.append(trigram_keys(alphabet[grams // (size * size)], alphabet[grams // size % size], alphabet[grams % size]))
+            doc_ids.append((packed % len(chunk) + first_id + start).astype(np.int32))
+        start += len(chunk)
+    if not keys:
+        return np.array([], dtype=np.uint64), np.zeros(1, dtype=np.int64), np.array([], dtype=np.int32)
+    # Chunks hold increasing ids, so a stable merge keeps the ids of each key ascending
+    keys, doc_ids = np.concatenate(keys), np.concatenate(doc_ids)
+    order = np.argsort(keys, kind="stable")
+    keys, doc_ids = keys[order], doc_ids[order]
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    return keys[starts], np.append(starts, len(keys)), doc_ids
+
+# Function to build the token posting lists of the documents: the sorted distinct whitespace-separated tokens,
+# and for each token the ascending document ids doc_ids[starts[i]:starts[i + 1]]
+def token_postings(docs, first_id=0):
+    lists = pc.utf8_split_whitespace(pa.array(docs, type=pa.string()))
+    tokens = pc.list_flatten(lists)
+    owner = pc.list_parent_indices(lists).to_numpy()
+    # Leading and trailing whitespace leave empty tokens that str.split() would drop
+    keep = pc.not_equal(tokens, "")
+    encoded = pc.dictionary_encode(tokens.filter(keep))
+    vocabulary = encoded.dictionary.to_numpy(zero_copy_only=False)
+    order = np.argsort(vocabulary)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    packed = np.unique(rank[encoded.indices.to_numpy()] * max(len(docs), 1) + owner[keep.to_numpy(zero_copy_only=False)])
+    starts = np.searchsorted(packed // max(len(docs), 1), np.arange(len(order) + 1))
+    return vocabulary[order].tolist(), starts, (packed % max(len(docs), 1) + first_id).astype(np.int32)
+
+# Function to merge posting lists with those of documents added after them, whose ids are all larger
+def merge_postings(keys, starts, doc_ids, new_keys, new_starts, new_doc_ids):
+    merged = np.union1d(keys, new_keys)
+    ranks = np.concatenate([np.repeat(np.searchsorted(merged, keys), np.diff(starts)),
+                            np.repeat(np.searchsorted(merged, new_keys), np.diff(new_starts))])
+    # Stable, so each key keeps its earlier ids ahead of the added ones
+    order = np.argsort(ranks, kind="stable")
+    return merged, np.searchsorted(ranks[order], np.arange(len(merged) + 1)), np.concatenate([doc_ids, new_doc_ids])[order]
+
+# Function to build the searchable document of each row: the lowercased text columns joined by newlines,
+# so matches can't span columns
+def search_documents(df, columns):
+    text = pd.Series("", index=df.index, dtype=object)
+    for col in columns:
+        text = text + "\n" + df[col].astype(object).where(df[col].notna(), "").astype(str).str.lower()
+    return text
+
+# Trigram and token inverted index over the searchable text columns
+class SearchIndex:
+    def __init__(self, df, columns=SEARCH_COLUMNS):
+        self.columns = [col for col in columns if col in df.columns]
+        codes, uniques = pd.factorize(search_documents(df, self.columns))
+        self.set_rows(codes)
+        # Arrow-backed strings let the candidate check run in one vectorized call
+        self.docs = pd.Series(uniques, dtype="string[pyarrow]")
+        # Posting lists are flat arrays: the ids of grams[i] are gram_docs[gram_starts[i]:gram_starts[i + 1]]
+        self.grams, self.gram_starts, self.gram_docs = trigram_postings(list(uniques))
+        self.tokens, self.token_starts, self.token_docs = token_postings(list(uniques))
+
+    # Group the rows by document: the rows of document d are order[starts[d]:starts[d + 1]]
+    def set_rows(self, codes):
+        self.order = np.argsort(codes, kind="stable").astype(np.int64)
+        self.starts = np.searchsorted(codes[self.order], np.arange(codes.max(initial=-1) + 2))
+
+    # A copy covering the rows appended from position start on; only documents not seen before are tokenized
+    def extended(self, df, start):
+        index = SearchIndex.__new__(SearchIndex)
+        index.columns = self.columns
+        text = search_documents(df.iloc[start:], self.columns)
+        codes = pd.Index(self.docs.astype(object)).get_indexer(text)
+        unseen = codes < 0
+        new_codes, new_docs = pd.factorize(text[unseen])
+        codes[unseen] = new_codes + len(self.docs)
+        old_codes = np.empty(len(self.order), dtype=np.int64)
+        old_codes[self.order] = np.repeat(np.arange(len(self.docs)), np.diff(self.starts))
+        index.set_rows(np.concatenate([old_codes, codes]))
+        index.docs = pd.concat([self.docs, pd.Series(new_docs, dtype="string[pyarrow]")], ignore_index=True)
+        index.grams, index.gram_starts, index.gram_docs = merge_postings(
+            self.grams, self.gram_starts, self.gram_docs, *trigram_postings(list(new_docs), len(self.docs)))
+        tokens, index.token_starts, index.token_docs = merge_postings(
+            np.array(self.tokens, dtype=object), self.token_starts, self.token_docs, *token_postings(list(new_docs), len(self.docs)))
+        index.tokens = tokens.tolist()
+        return index
+
+    # Distinct documents containing the query as a substring
+    def substring_docs(self, query):
+        codes = np.frombuffer(query.encode("utf-32-le"), dtype=np.uint32)
+        keys = np.unique(trigram_keys(codes[:-2], codes[1:-1], codes[2:]))
+        slots = np.minimum(np.searchsorted(self.grams, keys), len(self.grams) - 1)
+        if len(self.grams) == 0 or np.any(self.grams[slots] != keys):
+            return np.array([], dtype=np.int32)
+        postings = sorted((self.gram_docs[self.gram_starts[s]:self.gram_starts[s + 1]] for s in slots), key=len)
+        candidates = postings[0]
+        for p in postings[1:]:
+            candidates = np.intersect1d(candidates, p, assume_unique=True)
+            if len(candidates) == 0:
+                break
+        # Trigrams can co-occur without forming the query, so confirm the candidates; a lone trigram needs no check
+        if len(query) > 3 and len(candidates):
+            found = self.docs.take(candidates).str.contains(query, regex=False)
+            candidates = candidates[found.to_numpy(dtype=bool)]
+        return candidates
+
+    # Distinct documents with a word starting with the query
+    def prefix_docs(self, query):
+        start = bisect.bisect_left(self.tokens, query)
+        end = bisect.bisect_left(self.tokens, query + "\uffff")
+        if start == end:
+            return np.array([], dtype=np.int32)
+        return np.unique(self.token_docs[self.token_starts[start]:self.token_starts[end]])
+
+    # Row positions matching the query, optionally restricted to a sorted set of positions
+    def search(self, query, positions=None):
+        query = query.strip().lower()
+        if not query:
+            return positions if positions is not None else np.arange(len(self.order))
+        doc_ids = self.substring_docs(query) if len(query) >= 3 else self.prefix_docs(query)
+        if len(doc_ids) == 0:
+            return np.array([], dtype=np.int64)
+        # Expand distinct documents to their rows without a Python loop
+        lengths = self.starts[doc_ids + 1] - self.starts[doc_ids]
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        rows = np.sort(self.order[np.repeat(self.starts[doc_ids], lengths) + offsets])
+        if positions is not None:
+            rows = np.intersect1d(rows, positions, assume_unique=True)
+        return rows
+
+# Dense count cube over the dashboard dimensions; the last slot of each axis holds missing values
+class RecallCube:
+    def __init__(self, df, dimensions=CUBE_DIMENSIONS):
+        self.dimensions = [dim for dim in dimensions if dim in df.columns]
+        self.labels = {}
+        codes = []
+        for dim in self.dimensions:
+            dim_codes, uniques = pd.factorize(df[dim], sort=True)
+            self.labels[dim] = uniques.tolist()
+            codes.append(np.where(dim_codes < 0, len(self.labels[dim]), dim_codes))
+        self.shape = tuple(len(self.labels[dim]) + 1 for dim in self.dimensions)
+        self.counts = None
+        self.state_masks = None
+        if int(np.prod(self.shape, dtype=np.int64)) <= MAX_CUBE_CELLS:
+            cells = np.ravel_multi_index(codes, self.shape)
+            self.counts = np.bincount(cells, minlength=int(np.prod(self.shape))).reshape(self.shape)
+            if "State Mask" in df.columns:
+                # OR of the state masks of every record in a cell
+                state_masks = np.zeros(self.counts.size, dtype=np.uint64)
+                np.bitwise_or.at(state_masks, cells, df["State Mask"].to_numpy(dtype=np.uint64))
+                self.state_masks = state_masks.reshape(self.shape)
+        # Per-row codes for the few columns that can't be rolled up from counts
+        self.row_codes = {}
+        for col in CUBE_ROW_COLUMNS:
+            if col in df.columns:
+                col_codes, uniques = pd.factorize(df[col], sort=True)
+                self.row_codes[col] = (col_codes, uniques.tolist())
+
+    # A copy covering the rows appended from position start on: existing counts are moved into the widened
+    # axes and only the new rows are binned
+    def extended(self, df, start):
+        if self.counts is None or any(dim not in df.columns for dim in self.dimensions):
+            return RecallCube(df, self.dimensions)
+        new_rows = df.iloc[start:]
+        cube = RecallCube.__new__(RecallCube)
+        cube.dimensions = self.dimensions
+        cube.labels = {}
+        slots, codes = [], []
+        for dim in self.dimensions:
+            labels = merged_labels(self.labels[dim], new_rows[dim])
+            lookup = pd.Index(labels)
+            cube.labels[dim] = labels
+            # Old slot i moves to slots[i]; the missing-value slot stays last
+            slots.append(np.append(lookup.get_indexer(self.labels[dim]), len(labels)))
+            dim_codes = lookup.get_indexer(new_rows[dim].astype(object).where(new_rows[dim].notna(), None))
+            codes.append(np.where(dim_codes < 0, len(labels), dim_codes))
+        cube.shape = tuple(len(cube.labels[dim]) + 1 for dim in cube.dimensions)
+        if int(np.prod(cube.shape, dtype=np.int64)) > MAX_CUBE_CELLS:
+            return RecallCube(df, self.dimensions)
+        cells = np.ravel_multi_index(codes, cube.shape)
+        cube.counts = np.zeros(cube.shape, dtype=self.counts.dtype)
+        cube.counts[np.ix_(*slots)] = self.counts
+        cube.counts += np.bincount(cells, minlength=cube.counts.size).reshape(cube.shape)
+        cube.state_masks = None
+        if self.state_masks is not None:
+            cube.state_masks = np.zeros(cube.shape, dtype=np.uint64)
+            cube.state_masks[np.ix_(*slots)] = self.state_masks
+            flat = cube.state_masks.reshape(-1)
+            np.bitwise_or.at(flat, cells, new_rows["State Mask"].to_numpy(dtype=np.uint64))
+        cube.row_codes = {}
+        for col, (col_codes, labels) in self.row_codes.items():
+            new_labels = merged_labels(labels, new_rows[col])
+            lookup = pd.Index(new_labels)
+            remap = np.append(lookup.get_indexer(labels), -1)
+            added = lookup.get_indexer(new_rows[col].astype(object).where(new_rows[col].notna(), None))
+            cube.row_codes[col] = (np.concatenate([remap[col_codes], added]), new_labels)
+        return cube
+
+    # Restrict the cube to the selected filter values; None when a filter isn't a cube dimension
+    def slice(self, filters):
+        if self.counts is None:
+            return None
+        counts, state_masks = self.counts, self.state_masks
+        for col, selected in filters.items():
+            if not selected:
+                continue
+            if col not in self.dimensions:
+                return None
+            # Zero out unselected slots so every axis stays aligned with its labels
+            axis = self.dimensions.index(col)
+            keep = np.zeros(self.shape[axis], dtype=bool)
+            lookup = {value: i for i, value in enumerate(self.labels[col])}
+            keep[[lookup[value] for value in selected if value in lookup]] = True
+            keep = keep.reshape([-1 if i == axis else 1 for i in range(len(self.shape))])
+            counts = counts * keep
+            if state_masks is not None:
+                state_masks = np.where(keep, state_masks, np.uint64(0))
+        return counts, state_masks
+
+    # Counts along the given dimensions, summing over all the others
+    def rollup(self, counts, *dims):
+        keep = [self.dimensions.index(dim) for dim in dims]
+        return counts.sum(axis=tuple(i for i in range(counts.ndim) if i not in keep))
+
+# Function to turn a count vector into a top-N frame, dropping the missing-value slot and empty labels
+def counts_frame(counts, labels, columns, top=None):
+    frame = pd.DataFrame({columns[0]: labels, columns[1]: counts[:len(labels)]})
+    frame = frame[frame[columns[1]] > 0].sort_values(columns[1], ascending=False, kind="stable")
+    return frame.head(top).reset_index(drop=True) if top else frame.reset_index(drop=True)
+
+# Function to compute the dashboard aggregates as roll-ups of the cube, or None if the filters need a row scan
+def compute_cube_aggregates(cube, filters, positions):
+    sliced = cube.slice(filters)
+    if sliced is None or any(dim not in cube.dimensions for dim in CUBE_DIMENSIONS):
+        return None
+    counts, state_masks = sliced
+    labels = cube.labels
+
+    aggregates = {"total": int(counts.sum())}
+    food = cube.rollup(counts, "Food Category")
+    aggregates["food_category_count"] = int(np.count_nonzero(food[:-1]))
+    aggregates["affected_states"] = count_states(state_masks.ravel()) if state_masks is not None else 0
+
+    aggregates["recall_categories"] = counts_frame(cube.rollup(counts, "Recall Category"), labels["Recall Category"], ["Category", "Count"], top=10)
+    aggregates["food_categories"] = counts_frame(food, labels["Food Category"], ["Category", "Count"], top=10)
+
+    # Firm and detailed category counts come from their row codes over the slice
+    for key, col in [("unique_companies", "Recalling Firm Name"), ("detailed_categories", "Detailed Recall Category")]:
+        if col not in cube.row_codes:
+            aggregates[key] = 0 if key == "unique_companies" else None
+            continue
+        col_codes, col_labels = cube.row_codes[col]
+        slice_codes = col_codes[positions]
+        per_value = np.bincount(slice_codes[slice_codes >= 0], minlength=len(col_labels))
+        if key == "unique_companies":
+            aggregates[key] = int(np.count_nonzero(per_value))
+        else:
+            aggregates[key] = counts_frame(per_value, col_labels, ["Category", "Count"], top=10)
+
+    # Month and season labels are calendar-ordered categoricals, so the roll-ups are already in calendar order
+    month_numbers = np.array([MONTH_ORDER[month] for month in labels["Month Name"]], dtype=np.int64)
+    month_counts = cube.rollup(counts, "Month Name")[:-1]
+    observed = np.flatnonzero(month_counts)
+    aggregates["months"] = pd.DataFrame({
+        "Month": month_numbers[observed],
+        "Month Name": np.array(labels["Month Name"], dtype=object)[observed],
+        "Count": month_counts[observed]
+    })
+
+    # Year x month grid, flattened to the non-empty cells in chronological order
+    grid = cube.rollup(counts, "Year", "Month Name")[:-1, :-1]
+    year_idx, month_idx = np.nonzero(grid)
+    periods = np.array(labels["Year"], dtype=np.int64)[year_idx] * 12 + month_numbers[month_idx] - 1
+    aggregates["time_series"] = pd.DataFrame({
+        "Period": periods,
+        "Date": period_dates(periods),
+        "Count": grid[year_idx, month_idx]
+    })
+
+    season_counts = cube.rollup(counts, "Season")[:-1]
+    observed = np.flatnonzero(season_counts)
+    aggregates["seasons"] = pd.DataFrame({
+        "Season": np.array(labels["Season"], dtype=object)[observed],
+        "Count": season_counts[observed]
+    })
+    aggregates["company_sizes"] = counts_frame(cube.rollup(counts, "Company Size"), labels["Company Size"], ["Size", "Count"])
+    return aggregates
+
+# Function to build the count cube once per dataset version
+@st.cache_resource(max_entries=2)
+def get_recall_cube(_df, dataset_version):
+    return RecallCube(_df)
+
+# Row order by classification date (newest first, missing dates last) for paging without a sort
+class RecencyIndex:
+    def __init__(self, df, column=RECENCY_COLUMN):
+        self.size = len(df)
+        if column in df.columns:
+            values = pd.to_datetime(df[column], errors="coerce").to_numpy(dtype="datetime64[ns]").view(np.int64)
+            missing = np.isnat(values.view("datetime64[ns]"))
+            key = -np.where(missing, 0, values)
+            key[missing] = np.iinfo(np.int64).max
+            self.order = np.argsort(key, kind="stable")
+        else:
+            self.order = np.arange(self.size)
+        self.rank = np.empty(self.size, dtype=np.int64)
+        self.rank[self.order] = np.arange(self.size)
+
+    # Row positions of one page of the given rows, most recent first
+    def page(self, positions, offset, limit):
+        if len(positions) == self.size:
+            return self.order[offset:offset + limit]
+        ranks = self.rank[positions]
+        end = offset + limit
+        if end < len(ranks):
+            # Only the first `end` ranks need ordering
+            ranks = ranks[np.argpartition(ranks, end - 1)[:end]]
+        return self.order[np.sort(ranks)[offset:end]]
+
+# Function to build the recency index once per dataset version
+@st.cache_resource(max_entries=2)
+def get_recency_index(_df, dataset_version):
+    return RecencyIndex(_df)
+
+# Function to split text into lowercase word tokens for retrieval
+def retrieval_tokens(text):
+    return [token for token in re.findall(r"[a-z0-9]+", text.lower()) if token not in RETRIEVAL_STOPWORDS]
+
+# BM25 index over the recall records, stored as .npy arrays that are memory-mapped on load
+class RetrievalIndex:
+    ARRAYS = ["term_ptr", "doc_ids", "term_freqs", "doc_lengths"]
+
+    def __init__(self, vocabulary, arrays):
+        self.vocabulary = vocabulary
+        self.term_ptr = arrays["term_ptr"]
+        self.doc_ids = arrays["doc_ids"]
+        self.term_freqs = arrays["term_freqs"]
+        self.doc_lengths = arrays["doc_lengths"]
+        self.size = len(self.doc_lengths)
+        self.avg_length = float(self.doc_lengths.mean()) if self.size else 0.0
+
+    @classmethod
+    def build(cls, df, columns=RETRIEVAL_COLUMNS):
+        text = pd.Series("", index=pd.RangeIndex(len(df)), dtype=object)
+        for col in columns:
+            if col in df.columns:
+                values = df[col].astype(object).where(df[col].notna(), "").astype(str).to_numpy()
+                text = text + " " + values
+        tokens = text.str.lower().str.findall(r"[a-z0-9]+").explode().dropna()
+        tokens = tokens[~tokens.isin(RETRIEVAL_STOPWORDS)]
+        rows = tokens.index.to_numpy(dtype=np.int64)
+        term_ids, vocabulary = pd.factorize(tokens.to_numpy())
+        # One entry per (term, record) pair, grouped by term
+        pairs, counts = np.unique(term_ids.astype(np.int64) * max(len(df), 1) + rows, return_counts=True)
+        terms = pairs // max(len(df), 1)
+        arrays = {
+            "term_ptr": np.searchsorted(terms, np.arange(len(vocabulary) + 1)).astype(np.int64),
+            "doc_ids": (pairs % max(len(df), 1)).astype(np.int32),
+            "term_freqs": counts.astype(np.float32),
+            "doc_lengths": np.bincount(rows, minlength=len(df)).astype(np.float32)
+        }
+        return cls({term: i for i, term in enumerate(vocabulary.tolist())}, arrays)
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(tmp_path, "vocabulary.json"), "w") as f:
+            json.dump(self.vocabulary, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "vocabulary.json")) as f:
+            vocabulary = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in cls.ARRAYS}
+        return cls(vocabulary, arrays)
+
+    # BM25 scores of every record for the query, plus how many query terms each record contains
+    def score(self, query):
+        scores = np.zeros(self.size, dtype=np.float32)
+        matched = np.zeros(self.size, dtype=np.int16)
+        terms = [self.vocabulary[token] for token in dict.fromkeys(retrieval_tokens(query)) if token in self.vocabulary]
+        for term in terms:
+            start, end = self.term_ptr[term], self.term_ptr[term + 1]
+            docs = self.doc_ids[start:end]
+            tf = self.term_freqs[start:end]
+            idf = np.log(1 + (self.size - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[docs] / self.avg_length)
+            scores[docs] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+            matched[docs] += 1
+        return scores, matched, len(terms)
+
+    # Positions of the top-k records for the query, best first
+    def top(self, scores, k):
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+# Function to load the retrieval index for this dataset version from disk, building it on first use
+@st.cache_resource(max_entries=2)
+def get_retrieval_index(_df, dataset_version, cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, f"retrieval-{dataset_version}")
+    if os.path.isdir(path):
+        return RetrievalIndex.load(path)
+    index = RetrievalIndex.build(_df)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        index.save(path)
+        # Drop indexes of older dataset versions
+        for name in os.listdir(cache_dir):
+            if name.startswith("retrieval-") and name != os.path.basename(path) and ".tmp" not in name:
+                shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        return RetrievalIndex.load(path)
+    except OSError as e:
+        print(f"Could not persist retrieval index: {e}")
+        return index
+
+# Function to describe the records most relevant to a question, with aggregates over the matches
+def build_retrieval_context(df, index, question, top_k=RETRIEVAL_TOP_K):
+    scores, matched, term_count = index.score(question)
+    if term_count == 0 or not scores.any():
+        return ""
+    # Aggregate over records containing every query term, or the best-scoring pool if none do
+    full_matches = np.flatnonzero(matched == term_count)
+    pool = full_matches if len(full_matches) else index.top(scores, RETRIEVAL_AGGREGATE_POOL)
+    pool_frame = df.take(pool)
+
+    lines = ["RELEVANT RECORDS (retrieved from the recall database for this question):"]
+    if len(full_matches):
+        lines.append(f"- Records matching all question terms: {len(full_matches):,}")
+    else:
+        lines.append(f"- No record matches all question terms; figures below cover the {len(pool):,} closest records")
+    for col in ["Recall Category", "Detailed Recall Category", "Food Category", "Classification", "Year"]:
+        if col in pool_frame.columns:
+            counts = observed_counts(pool_frame[col]).head(5)
+            if len(counts):
+                lines.append(f"- By {col}: " + ", ".join(f"{value} ({count})" for value, count in counts.items()))
+    if "State Mask" in pool_frame.columns:
+        states = state_counts(pool_frame["State Mask"].to_numpy()).head(5)
+        if len(states):
+            lines.append("- Most affected states: " + ", ".join(f"{state} ({count})" for state, count in states.items()))
+
+    lines.append("Top matching records:")
+    record_columns = [col for col in ["Center Classification Date", "Recalling Firm Name", "Product Description",
+                                      "Reason for Recall", "Classification", "Status"] if col in df.columns]
+    for rank, position in enumerate(index.top(scores, top_k), start=1):
+        record = df.iloc[position]
+        fields = []
+        for col in record_columns:
+            value = record[col]
+            if pd.isna(value):
+                continue
+            if isinstance(value, pd.Timestamp):
+                value = value.strftime("%Y-%m-%d")
+            fields.append(str(value)[:200])
+        lines.append(f"{rank}. " + " | ".join(fields))
+    return truncate_to_tokens("\n".join(lines), RETRIEVAL_MAX_TOKENS)
+
+# Function to build the search index once per dataset version, unless an index extended from the previous version is given
+@st.cache_resource(max_entries=2)
+def get_search_index(_df, dataset_version, _index=None):
+    return _index if _index is not None else SearchIndex(_df)
+
+# Function to build the filter index once per dataset version
+@st.cache_resource(max_entries=4)
+def get_filter_index(_df, dataset_version, columns=tuple(FILTER_COLUMNS)):
+    return FilterIndex(_df, list(columns))
+
+# Function to estimate the memory held by a cached value
+def approx_size(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum()) if isinstance(value, pd.DataFrame) else int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, go.Figure):
+        return len(pio.to_json(value, validate=False))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(approx_size(v) for v in value)
+    return sys.getsizeof(value)
+
+# Thread-safe LRU cache bounded by entry count and approximate memory
+class LRUCache:
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value):
+        size = approx_size(value)
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                self.total_bytes -= self.entries.popitem(last=False)[1][1]
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+# Function to hash the selected filters and dataset version into a canonical key
+def filter_state_key(filters, dataset_version):
+    canonical = {col: sorted(str(v) for v in values) for col, values in filters.items() if values}
+    payload = json.dumps({"version": dataset_version, "filters": canonical}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+# Function to create the process-wide aggregation cache shared by all sessions
+@st.cache_resource
+def get_aggregation_cache():
+    return LRUCache(AGGREGATE_CACHE_MAX_ENTRIES, AGGREGATE_CACHE_MAX_BYTES)
+
+# Function to create the process-wide cache of built dashboard figures
+@st.cache_resource
+def get_figure_cache():
+    return LRUCache(FIGURE_CACHE_MAX_ENTRIES, FIGURE_CACHE_MAX_BYTES)
+
+# Function to fetch a chart's figure for one filter state, building it only on a miss
+def cached_figure(chart_id, state_key, build):
+    return get_figure_cache().get_or_compute(f"{chart_id}:{state_key}", build)
+
+# Function to compute every aggregate the dashboard renders for one filtered slice
+def compute_dashboard_aggregates(filtered_data):
+    aggregates = {"total": len(filtered_data)}
+    aggregates["unique_companies"] = filtered_data["Recalling Firm Name"].nunique()
+    aggregates["food_category_count"] = filtered_data["Food Category"].nunique()
+
+    # Distinct states across the slice, from the masks parsed at ingest
+    if "State Mask" in filtered_data.columns:
+        aggregates["affected_states"] = count_states(filtered_data["State Mask"].to_numpy())
+    else:
+        aggregates["affected_states"] = 0
+
+    # Top-10 breakdowns used by the bar and pie charts
+    for key, col in [("recall_categories", "Recall Category"),
+                     ("detailed_categories", "Detailed Recall Category"),
+                     ("food_categories", "Food Category")]:
+        if col in filtered_data.columns:
+            top = observed_counts(filtered_data[col]).head(10).reset_index()
+            top.columns = ["Category", "Count"]
+            aggregates[key] = top
+        else:
+            aggregates[key] = None
+
+    # Group on the integer calendar columns derived at ingest
+    if "Month" in filtered_data.columns:
+        month_counts = filtered_data["Month"].value_counts().sort_index()
+        months = month_counts.index.to_numpy(dtype=np.int64)
+        aggregates["months"] = pd.DataFrame({
+            "Month": months,
+            "Month Name": np.array(MONTH_NAMES, dtype=object)[months - 1],
+            "Count": month_counts.to_numpy()
+        })
+    else:
+        aggregates["months"] = None
+
+    if "Period" in filtered_data.columns:
+        period_counts = filtered_data["Period"].value_counts().sort_index()
+        periods = period_counts.index.to_numpy(dtype=np.int64)
+        aggregates["time_series"] = pd.DataFrame({"Period": periods, "Date": period_dates(periods), "Count": period_counts.to_numpy()})
+    else:
+        aggregates["time_series"] = None
+
+    if "Season" in filtered_data.columns:
+        # Ordered categorical: counts come back in calendar order
+        season_counts = filtered_data["Season"].value_counts(sort=False)
+        season_counts = season_counts[season_counts > 0]
+        aggregates["seasons"] = pd.DataFrame({"Season": season_counts.index.astype(object), "Count": season_counts.to_numpy()})
+    else:
+        aggregates["seasons"] = None
+
+    if "Company Size" in filtered_data.columns:
+        company_size = observed_counts(filtered_data["Company Size"]).reset_index()
+        company_size.columns = ["Size", "Count"]
+        aggregates["company_sizes"] = company_size
+    else:
+        aggregates["company_sizes"] = None
+
+    return aggregates
+
+# Function to pivot long-format (recall category, food category, period, count) arrays into one dense monthly
+# series per category pair: a (series x months) count matrix, the pair of each row and the period of column 0
+def series_matrix(recall_categories, food_categories, periods, counts):
+    periods = np.asarray(periods, dtype=np.int64)
+    if len(periods) == 0:
+        return np.zeros((0, 0), dtype=np.int64), [], 0
+    codes, pairs = pd.factorize(pd.MultiIndex.from_arrays([np.asarray(recall_categories, dtype=object),
+                                                           np.asarray(food_categories, dtype=object)]), sort=True)
+    first_period = int(periods.min())
+    matrix = np.zeros((len(pairs), int(periods.max()) - first_period + 1), dtype=np.int64)
+    np.add.at(matrix, (codes, periods - first_period), np.asarray(counts, dtype=np.int64))
+    return matrix, list(pairs), first_period
+
+# Function to read the category series off the count cube, without touching the rows
+def cube_series_counts(cube):
+    # rollup keeps the cube's axis order; the last slot of each axis holds missing values
+    dims = sorted(["Year", "Month Name", "Recall Category", "Food Category"], key=cube.dimensions.index)
+    grid = cube.rollup(cube.counts, *dims)[(slice(None, -1),) * len(dims)]
+    cells = np.nonzero(grid)
+    axes = dict(zip(dims, cells))
+    years = np.array(cube.labels["Year"], dtype=np.int64)[axes["Year"]]
+    months = np.array([MONTH_ORDER[month] for month in cube.labels["Month Name"]], dtype=np.int64)[axes["Month Name"]]
+    return series_matrix(np.array(cube.labels["Recall Category"], dtype=object)[axes["Recall Category"]],
+                         np.array(cube.labels["Food Category"], dtype=object)[axes["Food Category"]],
+                         years * 12 + months - 1, grid[cells])
+
+# Function to count the category series from the rows, for when there is no cube
+def frame_series_counts(df):
+    columns = ["Recall Category", "Food Category", "Period"]
+    if any(col not in df.columns for col in columns):
+        return series_matrix([], [], [], [])
+    counts = df.groupby(columns, observed=True).size()
+    counts = counts[counts > 0]
+    return series_matrix(counts.index.get_level_values(0), counts.index.get_level_values(1),
+                         counts.index.get_level_values(2), counts.to_numpy())
+
+# Function to compute trailing-window means and variances along the month axis, excluding the month itself
+def trailing_stats(matrix, window, min_months):
+    sums = np.zeros((matrix.shape[0], matrix.shape[1] + 1))
+    squares = np.zeros_like(sums)
+    np.cumsum(matrix, axis=1, out=sums[:, 1:])
+    np.cumsum(matrix.astype(float) ** 2, axis=1, out=squares[:, 1:])
+    end = np.arange(matrix.shape[1])
+    start = np.maximum(end - window, 0)
+    months = end - start
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (sums[:, end] - sums[:, start]) / months
+        var = (squares[:, end] - squares[:, start]) / months - mean ** 2
+    mean[:, months < min_months] = np.nan
+    return mean, np.maximum(var, 0)
+
+# Rolling baselines, z-scores and change-points for every Recall Category x Food Category monthly series at once.
+# Given the analysis of the previous dataset version, only the months the new data can affect are recomputed
+class TrendAnalysis:
+    def __init__(self, matrix, series, first_period, version=None, previous=None):
+        self.matrix = matrix
+        self.series = series
+        self.first_period = first_period
+        self.version = version
+        months = matrix.shape[1]
+        shape = matrix.shape
+        self.baseline = np.full(shape, np.nan)
+        self.zscores = np.full(shape, np.nan)
+        self.shift_before = np.full(shape, np.nan)
+        self.shift_after = np.full(shape, np.nan)
+        self.shifts = np.full(shape, np.nan)
+
+        # A month's baseline looks back TREND_BASELINE_MONTHS and its change-point score TREND_SHIFT_MONTHS either
+        # way, so earlier months keep their previous results
+        start = 0
+        if (previous is not None and previous.series == series and previous.first_period == first_period
+                and previous.matrix.shape[1] <= months):
+            old_months = previous.matrix.shape[1]
+            changed = np.flatnonzero((matrix[:, :old_months] != previous.matrix).any(axis=0))
+            start = max(0, min(changed[0] if len(changed) else old_months, old_months) - TREND_SHIFT_MONTHS)
+            for name in ("baseline", "zscores", "shift_before", "shift_after", "shifts"):
+                getattr(self, name)[:, :start] = getattr(previous, name)[:, :start]
+        if months and start < months:
+            self.compute(start)
+
+        # Least-squares slope of the recent months, in recalls per month
+        recent = matrix[:, -TREND_SLOPE_MONTHS:].astype(float)
+        steps = np.arange(recent.shape[1]) - (recent.shape[1] - 1) / 2
+        self.slopes = recent @ steps / max(float(steps @ steps), 1.0)
+        self.recent_means = recent.mean(axis=1) if recent.shape[1] else np.zeros(len(series))
+        self.flagged = None
+
+    # Fill every result from month start on, from a slice of the matrix reaching just far enough back
+    def compute(self, start):
+        window, half = TREND_BASELINE_MONTHS, TREND_SHIFT_MONTHS
+        lo = max(0, start - max(window, half))
+        counts = self.matrix[:, lo:].astype(float)
+
+        mean, var = trailing_stats(counts, window, TREND_MIN_BASELINE_MONTHS)
+        # The spread is at least Poisson noise, so sparse series don't flag every single recall
+        spread = np.maximum(np.sqrt(np.maximum(var, np.nan_to_num(mean))), 1.0)
+        self.baseline[:, start:] = mean[:, start - lo:]
+        self.zscores[:, start:] = ((counts - mean) / spread)[:, start - lo:]
+
+        # Change-point score: the difference between the means of the months before t and from t on, in standard
+        # errors. The "after" window is a trailing window over the reversed series, padded by one month so it
+        # includes t itself
+        before_mean, before_var = trailing_stats(counts, half, half)
+        reversed_counts = np.concatenate([counts[:, ::-1], np.zeros((len(counts), 1))], axis=1)
+        after_mean, after_var = trailing_stats(reversed_counts, half, half)
+        after_mean, after_var = after_mean[:, 1:][:, ::-1], after_var[:, 1:][:, ::-1]
+        noise = np.sqrt((np.maximum(before_var, before_mean) + np.maximum(after_var, after_mean)) / half)
+        shifts = (after_mean - before_mean) / np.maximum(noise, 1.0 / half)
+        self.shift_before[:, start:] = before_mean[:, start - lo:]
+        self.shift_after[:, start:] = after_mean[:, start - lo:]
+        self.shifts[:, start:] = shifts[:, start - lo:]
+
+    # Flagged months as a frame, most recent first: spikes (a month far above its trailing baseline) and
+    # change-points (where the level of a series shifts, at the strongest month of each shift)
+    def anomalies(self):
+        if self.flagged is None:
+            self.flagged = self.find_anomalies()
+        return self.flagged
+
+    def find_anomalies(self):
+        columns = ["Type", "Recall Category", "Food Category", "Period", "Month", "Count", "Baseline", "Score"]
+        if self.matrix.size == 0:
+            return pd.DataFrame(columns=columns)
+        with np.errstate(invalid="ignore"):
+            spikes = ((self.zscores >= TREND_Z_THRESHOLD) & (self.matrix >= TREND_MIN_COUNT)
+                      & (self.matrix >= TREND_MIN_RATIO * self.baseline))
+            strength = np.nan_to_num(np.abs(self.shifts))
+            # Keep only the peak of each shift: the largest score within TREND_SHIFT_MONTHS either way
+            padded = np.pad(strength, ((0, 0), (TREND_SHIFT_MONTHS, TREND_SHIFT_MONTHS)))
+            peaks = np.lib.stride_tricks.sliding_window_view(padded, 2 * TREND_SHIFT_MONTHS + 1, axis=1).max(axis=2)
+            shifts = ((strength >= TREND_SHIFT_THRESHOLD) & (strength == peaks)
+                      & (np.fmax(self.shift_before, self.shift_after) >= TREND_MIN_COUNT / 2))
+
+        pairs = np.array(self.series, dtype=object).reshape(-1, 2)
+        frames = []
+        for kind, mask, count, baseline, score in [
+            ("Spike", spikes, self.matrix, self.baseline, self.zscores),
+            ("Shift", shifts, self.shift_after, self.shift_before, self.shifts)
+        ]:
+            rows, months = np.nonzero(mask)
+            score_values = score[rows, months]
+            frames.append(pd.DataFrame({
+                "Type": kind if kind == "Spike" else np.where(score_values > 0, "Shift up", "Shift down"),
+                "Recall Category": pairs[rows, 0],
+                "Food Category": pairs[rows, 1],
+                "Period": months + self.first_period,
+                "Month": period_dates(months + self.first_period),
+                "Count": np.round(count[rows, months], 1),
+                "Baseline": np.round(baseline[rows, months], 1),
+                "Score": np.round(score_values, 1)
+            }))
+        result = pd.concat(frames, ignore_index=True)
+        result["Strength"] = result["Score"].abs()
+        return result.sort_values(["Period", "Strength"], ascending=False).drop(columns="Strength").reset_index(drop=True)
+
+    # Series with the steepest recent rise or fall, relative to their recent level
+    def trends(self, limit=5):
+        columns = ["Recall Category", "Food Category", "Recent Mean", "Slope"]
+        if self.matrix.size == 0:
+            return pd.DataFrame(columns=columns)
+        pairs = np.array(self.series, dtype=object).reshape(-1, 2)
+        frame = pd.DataFrame({
+            "Recall Category": pairs[:, 0],
+            "Food Category": pairs[:, 1],
+            "Recent Mean": np.round(self.recent_means, 2),
+            "Slope": np.round(self.slopes, 3)
+        })
+        frame = frame[frame["Recent Mean"] >= TREND_MIN_COUNT / 2]
+        order = np.argsort(-np.abs(frame["Slope"].to_numpy() / frame["Recent Mean"].to_numpy()), kind="stable")
+        return frame.iloc[order[:limit]].reset_index(drop=True)
+
+    # Plain-text summary of the flagged months and steepest trends, for the LLM prompts
+    def context(self, limit=TREND_MAX_ANOMALIES):
+        anomalies = self.anomalies()
+        if anomalies.empty:
+            return "No months stand out from their recent baselines."
+        lines = [f"Flagged months (recalls per recall category and food category vs the trailing {TREND_BASELINE_MONTHS}-month mean):"]
+        for row in anomalies.head(limit).itertuples(index=False):
+            month = f"{row.Period // 12}-{row.Period % 12 + 1:02d}"
+            if row.Type == "Spike":
+                lines.append(f"- {month} {row[1]} / {row[2]}: spike, {row.Count:g} recalls vs baseline {row.Baseline:g} (z = {row.Score:g})")
+            else:
+                direction = "up" if row.Score > 0 else "down"
+                lines.append(f"- {month} {row[1]} / {row[2]}: level shift {direction} from {row.Baseline:g} to {row.Count:g} "
+                             f"recalls per month (score {row.Score:g})")
+        trends = self.trends()
+        if not trends.empty:
+            lines.append(f"Steepest trends over the last {TREND_SLOPE_MONTHS} months:")
+            for row in trends.itertuples(index=False):
+                lines.append(f"- {row[0]} / {row[1]}: {row.Slope:+g} recalls per month (recent mean {row[2]:g})")
+        return "\n".join(lines)
+
+    # Function to keep only the flagged months inside the sidebar filters
+    @staticmethod
+    def filter_anomalies(anomalies, filters):
+        mask = np.ones(len(anomalies), dtype=bool)
+        for col, values in filters.items():
+            if not values:
+                continue
+            if col in ("Recall Category", "Food Category"):
+                mask &= anomalies[col].isin(values).to_numpy()
+            elif col == "Year":
+                mask &= (anomalies["Period"] // 12).isin(values).to_numpy()
+            elif col == "Month Name":
+                mask &= (anomalies["Period"] % 12 + 1).isin([MONTH_ORDER[month] for month in values]).to_numpy()
+        return anomalies[mask]
+
+# Keeps the trend analysis of the latest dataset version so the next one can be computed incrementally
+class TrendTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest = None
+
+    # The analysis for a dataset version; series_counts returns the (matrix, series, first period) to analyze
+    def analyze(self, version, series_counts):
+        with self.lock:
+            if self.latest is None or self.latest.version != version:
+                matrix, series, first_period = series_counts()
+                self.latest = TrendAnalysis(matrix, series, first_period, version, previous=self.latest)
+            return self.latest
+
+# Function to create the process-wide trend tracker
+@st.cache_resource
+def get_trend_tracker():
+    return TrendTracker()
+
+# The recall frame shared by every session: the workbook snapshot plus the ingested partitions. Appending builds a
+# new frame and a new backend over it, so a frame a session holds never changes under it; treat it as read-only
+# and keep row positions and take() copies of just the rows shown
+class DatasetStore:
+    def __init__(self, source=DATA_FILE, cache_dir=CACHE_DIR, incoming_dir=INCOMING_DIR, partitions_dir=PARTITIONS_DIR):
+        self.incoming_dir = incoming_dir
+        self.partitions_dir = partitions_dir
+        self.lock = threading.Lock()
+        frame = load_snapshot(source, cache_dir)
+        self.base_version = frame.attrs["dataset_version"]
+        self.backend = PandasBackend(frame)
+        self.applied = []
+        self.recall_numbers = set()
+        if "Recall Number" in frame.columns:
+            self.recall_numbers = set(frame["Recall Number"].dropna().astype(str))
+        self.checked_at = 0.0
+        self.refresh(force=True)
+
+    # Function to ingest new incoming files and append every partition not yet applied; returns the current backend
+    def refresh(self, force=False):
+        if not force and time.time() - self.checked_at < INGEST_POLL_SECONDS:
+            return self.backend
+        with self.lock:
+            self.checked_at = time.time()
+            try:
+                ingest_incoming(self.recall_numbers, self.incoming_dir, self.partitions_dir)
+            except OSError as e:
+                print(f"Could not ingest incoming recalls: {e}")
+            pending = [entry for entry in read_partitions_manifest(self.partitions_dir)["partitions"]
+                       if entry["file"] not in self.applied]
+            if not pending:
+                return self.backend
+
+            # Build the new frame and indexes first; the store only records the partitions once they all succeed
+            backend = self.backend
+            frame, start = backend.frame, len(backend.frame)
+            applied = list(self.applied)
+            recall_numbers = set(self.recall_numbers)
+            parts = []
+            for entry in pending:
+                rows = feather.read_table(os.path.join(self.partitions_dir, entry["file"])).to_pandas()
+                if "Recall Number" in rows.columns:
+                    numbers = rows["Recall Number"].where(rows["Recall Number"].isna(), rows["Recall Number"].astype(str))
+                    rows = rows[~numbers.isin(recall_numbers)]
+                    recall_numbers.update(rows["Recall Number"].dropna().astype(str))
+                if len(rows):
+                    parts.append(rows.astype(object))
+                applied.append(entry["file"])
+            # One append for the whole batch, so the frame is copied once however many partitions are pending
+            if parts:
+                frame = append_rows(frame, pd.concat(parts, ignore_index=True))
+
+            if frame is backend.frame:
+                # Every row was a duplicate: same data under the new version, without relabeling the frame sessions hold
+                frame = frame.copy(deep=False)
+                cube, filter_index, search_index = backend.cube, backend.filter_index, backend.search_index
+            else:
+                # Extend the indexes the old version already built by the appended rows instead of rebuilding them
+                cube = backend.cube.extended(frame, start) if backend.cube is not None else None
+                filter_index = backend.filter_index.extended(frame, start) if backend.filter_index is not None else None
+                search_index = backend.search_index.extended(frame, start) if backend.search_index is not None else None
+            frame.attrs["dataset_version"] = partitioned_version(self.base_version, applied)
+            self.backend = PandasBackend(frame, cube=cube, filter_index=filter_index, search_index=search_index)
+            self.applied = applied
+            self.recall_numbers = recall_numbers
+            return self.backend
+
+# Function to keep one dataset store per process
+@st.cache_resource
+def get_dataset_store():
+    return DatasetStore()
+
 # Function to load the data
-@st.cache_data
 def load_data():
     try:
-        df = pd.read_excel("main usa food recall.xlsx")
-        return df
+        return get_dataset_store().refresh().frame
     except Exception as e:
         st.error(f"Error loading Excel file: {str(e)}")
         return pd.DataFrame()
         
+# Dashboard queries answered from the in-memory frame through its indexes and count cube
+class PandasBackend:
+    name = "pandas"
+
+    def __init__(self, df, cube=None, filter_index=None, search_index=None):
+        self.frame = df
+        self.version = df.attrs.get("dataset_version")
+        self.columns = list(df.columns)
+        # Built on first use unless carried over from the previous dataset version
+        self.cube = cube
+        self.filter_index = filter_index
+        self.search_index = search_index
+
+    def get_filter_index(self):
+        if self.filter_index is None:
+            self.filter_index = get_filter_index(self.frame, self.version)
+        return self.filter_index
+
+    def get_cube(self):
+        if self.cube is None:
+            self.cube = get_recall_cube(self.frame, self.version)
+        return self.cube
+
+    # A carried-over index also seeds the per-version cache, so the chat tool searches the same index
+    def get_search_index(self):
+        self.search_index = get_search_index(self.frame, self.version, self.search_index)
+        return self.search_index
+
+    def select(self, filters):
+        return self.get_filter_index().select(filters)
+
+    def rows(self, positions):
+        return self.frame if len(positions) == len(self.frame) else self.frame.take(positions)
+
+    def distinct(self, col):
+        return sorted(self.frame[col].dropna().unique().tolist())
+
+    # Most frequent values of a column, optionally within a filtered slice
+    def top_values(self, col, limit, filters=None):
+        values = self.frame[col] if not filters else self.frame[col].take(self.select(filters))
+        return observed_counts(values).head(limit).index.tolist()
+
+    # Dashboard aggregates, rolled up from the count cube unless a filter falls outside its dimensions
+    def aggregates(self, filters):
+        positions = self.select(filters)
+        return (compute_cube_aggregates(self.get_cube(), filters, positions)
+                or compute_dashboard_aggregates(self.rows(positions)))
+
+    # Monthly Recall Category x Food Category counts for trend detection, read off the count cube
+    def series_counts(self):
+        cube = self.get_cube()
+        if cube.counts is None or any(dim not in cube.dimensions for dim in ["Year", "Month Name", "Recall Category", "Food Category"]):
+            return frame_series_counts(self.frame)
+        return cube_series_counts(cube)
+
+    def matching_positions(self, filters, search_term):
+        positions = self.select(filters)
+        if search_term:
+            # Look the term up in the inverted index and keep only rows inside the filters
+            positions = self.get_search_index().search(search_term, positions)
+        return positions
+
+    def count(self, filters, search_term=""):
+        return len(self.matching_positions(filters, search_term))
+
+    # One page of matching recalls, most recent first; only the rows on the page are copied
+    def page(self, filters, search_term, offset, limit, columns):
+        positions = get_recency_index(self.frame, self.version).page(self.matching_positions(filters, search_term), offset, limit)
+        return self.frame.take(positions)[columns]
+
+# Dashboard queries compiled to SQL over an SQLite copy of the recalls, so the dashboard never needs the frame in memory
+class SQLiteBackend:
+    name = "sqlite"
+
+    def __init__(self, path, base_version, partitions_dir=PARTITIONS_DIR, incoming_dir=INCOMING_DIR):
+        self.path = path
+        self.base_version = base_version
+        self.partitions_dir = partitions_dir
+        self.incoming_dir = incoming_dir
+        self.frame = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        conn = self.connect()
+        info = conn.execute("PRAGMA table_info(recalls)").fetchall()
+        self.columns = [row[1] for row in info if row[1] not in ("position", "search_text")]
+        self.applied = [row[0] for row in conn.execute("SELECT file FROM partitions ORDER BY rowid")]
+        self.version = partitioned_version(base_version, self.applied)
+        self.recall_numbers = set()
+        if "Recall Number" in self.columns:
+            rows = conn.execute('SELECT "Recall Number" FROM recalls WHERE "Recall Number" IS NOT NULL')
+            self.recall_numbers = {str(row[0]) for row in rows}
+        self.checked_at = 0.0
+
+    # One read-only connection per thread
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=10)
+            self.local.conn = conn
+        return conn
+
+    # Function to convert frame rows into table rows, numbering their positions from start
+    @staticmethod
+    def table_rows(df, start=0):
+        table = pd.DataFrame({"position": np.arange(start, start + len(df), dtype=np.int64)})
+        for col in df.columns:
+            values = df[col]
+            if col in DATE_COLUMNS:
+                values = values.dt.strftime("%Y-%m-%d %H:%M:%S")
+            elif col == "State Mask":
+                values = values.astype(np.int64)
+            elif isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype(object)
+            table[col] = values.to_numpy()
+        # Lowercased text for search, fields joined by newlines so matches can't span columns
+        text = pd.Series("", index=df.index, dtype=object)
+        for col in [col for col in SEARCH_COLUMNS if col in df.columns]:
+            text = text + "\n" + df[col].astype(object).where(df[col].notna(), "").astype(str).str.lower()
+        table["search_text"] = text.to_numpy()
+        return table
+
+    # Function to write the frame into a new database file with one index per filter column
+    @classmethod
+    def build(cls, df, path):
+        table = cls.table_rows(df)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with sqlite3.connect(tmp_path) as conn:
+            table.to_sql("recalls", conn, index=False, chunksize=10000)
+            for col in FILTER_COLUMNS + [RECENCY_COLUMN]:
+                if col in df.columns:
+                    conn.execute(f'CREATE INDEX "idx_{col}" ON recalls ("{col}")')
+            conn.execute("ANALYZE")
+        os.replace(tmp_path, path)
+
+    # Function to open the database for the current workbook version, building it from the snapshot if needed
+    @classmethod
+    def open(cls, source=DATA_FILE, cache_dir=CACHE_DIR):
+        version = source_version(source, cache_dir)[0]
+        path = os.path.join(cache_dir, f"recalls-{version}.sqlite")
+        if not os.path.exists(path):
+            df = load_snapshot(source, cache_dir)
+            version = df.attrs["dataset_version"]
+            path = os.path.join(cache_dir, f"recalls-{version}.sqlite")
+            os.makedirs(cache_dir, exist_ok=True)
+            cls.build(df, path)
+            # Drop databases of older workbook versions
+            for name in os.listdir(cache_dir):
+                if name.startswith("recalls-") and name.endswith(".sqlite") and name != os.path.basename(path):
+                    os.remove(os.path.join(cache_dir, name))
+        # Partitions appended since the build, in order
+        with sqlite3.connect(path, timeout=30) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS partitions (file TEXT PRIMARY KEY)")
+        return cls(path, version)
+
+    # Function to ingest new incoming files and insert every partition not yet in the database; returns the backend
+    def refresh(self, force=False):
+        if not force and time.time() - self.checked_at < INGEST_POLL_SECONDS:
+            return self
+        with self.lock:
+            self.checked_at = time.time()
+            try:
+                ingest_incoming(self.recall_numbers, self.incoming_dir, self.partitions_dir)
+            except OSError as e:
+                print(f"Could not ingest incoming recalls: {e}")
+            pending = [entry for entry in read_partitions_manifest(self.partitions_dir)["partitions"]
+                       if entry["file"] not in self.applied]
+            if not pending:
+                return self
+
+            with sqlite3.connect(self.path, timeout=30) as conn:
+                applied = {row[0] for row in conn.execute("SELECT file FROM partitions")}
+                start = conn.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM recalls").fetchone()[0]
+                for entry in pending:
+                    # Another process may have inserted it already
+                    if entry["file"] in applied:
+                        continue
+                    rows = feather.read_table(os.path.join(self.partitions_dir, entry["file"])).to_pandas()
+                    if "Recall Number" in rows.columns:
+                        numbers = rows["Recall Number"].where(rows["Recall Number"].isna(), rows["Recall Number"].astype(str))
+                        rows = rows[~numbers.isin(self.recall_numbers)]
+                    rows = rows[[col for col in rows.columns if col in self.columns]]
+                    if len(rows):
+                        self.table_rows(rows.reset_index(drop=True), start).to_sql("recalls", conn, index=False, if_exists="append")
+                        start += len(rows)
+                    conn.execute("INSERT INTO partitions (file) VALUES (?)", (entry["file"],))
+                self.applied = [row[0] for row in conn.execute("SELECT file FROM partitions ORDER BY rowid")]
+            if "Recall Number" in self.columns:
+                rows = self.connect().execute('SELECT "Recall Number" FROM recalls WHERE "Recall Number" IS NOT NULL')
+                self.recall_numbers = {str(row[0]) for row in rows}
+            self.version = partitioned_version(self.base_version, self.applied)
+            return self
+
+    # WHERE clause for the filters plus any extra conditions; values in a column are ORed, columns ANDed
+    def where(self, filters, search_term="", conditions=()):
+        clauses = list(conditions)
+        params = []
+        for col, values in (filters or {}).items():
+            if values and col in self.columns:
+                clauses.append(f'"{col}" IN ({", ".join("?" * len(values))})')
+                params += [value.item() if isinstance(value, np.generic) else value for value in values]
+        query = search_term.strip().lower() if search_term else ""
+        if len(query) >= 3:
+            clauses.append("instr(search_text, ?) > 0")
+            params.append(query)
+        elif query:
+            # Short terms match the start of any word
+            clauses.append("instr(' ' || replace(search_text, char(10), ' '), ?) > 0")
+            params.append(" " + query)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def query(self, sql, params=()):
+        return pd.read_sql_query(sql, self.connect(), params=params)
+
+    def distinct(self, col):
+        rows = self.connect().execute(f'SELECT DISTINCT "{col}" FROM recalls WHERE "{col}" IS NOT NULL ORDER BY 1').fetchall()
+        return [row[0] for row in rows]
+
+    def top_values(self, col, limit, filters=None):
+        where, params = self.where(filters, conditions=[f'"{col}" IS NOT NULL'])
+        rows = self.connect().execute(
+            f'SELECT "{col}" FROM recalls{where} GROUP BY 1 ORDER BY COUNT(*) DESC, 1 LIMIT ?', params + [limit]
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    # Counts of each value of a column in the filtered slice, most frequent first
+    def value_counts(self, col, filters, names, limit=None):
+        where, params = self.where(filters, conditions=[f'"{col}" IS NOT NULL'])
+        sql = f'SELECT "{col}" AS "{names[0]}", COUNT(*) AS "{names[1]}" FROM recalls{where} GROUP BY 1 ORDER BY 2 DESC, 1'
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return self.query(sql, params)
+
+    # The same aggregates as compute_dashboard_aggregates, computed by the database
+    def aggregates(self, filters):
+        where, params = self.where(filters)
+        conn = self.connect()
+        columns = self.columns
+        aggregates = {}
+        aggregates["total"], aggregates["unique_companies"], aggregates["food_category_count"] = conn.execute(
+            f'SELECT COUNT(*), COUNT(DISTINCT "Recalling Firm Name"), COUNT(DISTINCT "Food Category") FROM recalls{where}', params
+        ).fetchone()
+
+        # Rows per state bit; a state counts as affected when any row has its bit set
+        if "State Mask" in columns:
+            state_rows = conn.execute(
+                "SELECT " + ", ".join(f'COALESCE(SUM(("State Mask" >> {bit}) & 1), 0)' for bit in range(len(US_STATES)))
+                + f" FROM recalls{where}", params
+            ).fetchone()
+            aggregates["affected_states"] = sum(1 for count in state_rows if count)
+        else:
+            aggregates["affected_states"] = 0
+
+        for key, col in [("recall_categories", "Recall Category"),
+                         ("detailed_categories", "Detailed Recall Category"),
+                         ("food_categories", "Food Category")]:
+            aggregates[key] = self.value_counts(col, filters, ["Category", "Count"], limit=10) if col in columns else None
+
+        if "Month" in columns:
+            where_m, params_m = self.where(filters, conditions=['"Month" IS NOT NULL'])
+            month_data = self.query(f'SELECT "Month", COUNT(*) AS "Count" FROM recalls{where_m} GROUP BY 1 ORDER BY 1', params_m)
+            month_data.insert(1, "Month Name", np.array(MONTH_NAMES, dtype=object)[month_data["Month"].to_numpy(dtype=np.int64) - 1])
+            aggregates["months"] = month_data
+        else:
+            aggregates["months"] = None
+
+        if "Period" in columns:
+            where_p, params_p = self.where(filters, conditions=['"Period" IS NOT NULL'])
+            time_data = self.query(f'SELECT "Period", COUNT(*) AS "Count" FROM recalls{where_p} GROUP BY 1 ORDER BY 1', params_p)
+            time_data.insert(1, "Date", period_dates(time_data["Period"].to_numpy()))
+            aggregates["time_series"] = time_data
+        else:
+            aggregates["time_series"] = None
+
+        if "Season" in columns:
+            where_s, params_s = self.where(filters, conditions=['"Season" IS NOT NULL'])
+            order = "CASE \"Season\" " + " ".join(f"WHEN '{name}' THEN {i}" for i, name in enumerate(SEASON_NAMES)) + " END"
+            aggregates["seasons"] = self.query(
+                f'SELECT "Season", COUNT(*) AS "Count" FROM recalls{where_s} GROUP BY 1 ORDER BY {order}', params_s
+            )
+        else:
+            aggregates["seasons"] = None
+
+        aggregates["company_sizes"] = self.value_counts("Company Size", filters, ["Size", "Count"]) if "Company Size" in columns else None
+        return aggregates
+
+    def series_counts(self):
+        if any(col not in self.columns for col in ["Recall Category", "Food Category", "Period"]):
+            return series_matrix([], [], [], [])
+        counts = self.query(
+            'SELECT "Recall Category", "Food Category", "Period", COUNT(*) AS "Count" FROM recalls '
+            'WHERE "Recall Category" IS NOT NULL AND "Food Category" IS NOT NULL AND "Period" IS NOT NULL GROUP BY 1, 2, 3'
+        )
+        return series_matrix(counts["Recall Category"], counts["Food Category"], counts["Period"], counts["Count"])
+
+    def count(self, filters, search_term=""):
+        where, params = self.where(filters, search_term)
+        return self.connect().execute(f"SELECT COUNT(*) FROM recalls{where}", params).fetchone()[0]
+
+    def page(self, filters, search_term, offset, limit, columns):
+        where, params = self.where(filters, search_term)
+        order = f'"{RECENCY_COLUMN}" IS NULL, "{RECENCY_COLUMN}" DESC, position' if RECENCY_COLUMN in self.columns else "position"
+        select = ", ".join(f'"{col}"' for col in columns)
+        rows = self.query(f"SELECT {select} FROM recalls{where} ORDER BY {order} LIMIT ? OFFSET ?", params + [limit, offset])
+        for col in columns:
+            if col in DATE_COLUMNS:
+                rows[col] = pd.to_datetime(rows[col])
+        return rows
+
+# Function to open the configured dashboard backend once per process
+@st.cache_resource
+def get_query_backend():
+    if get_setting("DATA_BACKEND", "pandas") == "sqlite":
+        return SQLiteBackend.open()
+    return get_dataset_store()
+
+# Function to load the dashboard backend for the current dataset version, or None when the data can't be loaded
+def load_backend():
+    try:
+        return get_query_backend().refresh()
+    except Exception as e:
+        st.error(f"Error loading Excel file: {str(e)}")
+        return None
+
+# Function to read a setting from Streamlit secrets, falling back to the environment
+def get_setting(name, default=None):
+    try:
+        # Checking for the file first keeps Streamlit from rendering a missing-secrets error
+        if st.secrets.load_if_toml_exists() and name in st.secrets:
+            return st.secrets[name]
+    except Exception:
+        # Unreadable secrets file
+        pass
+    return os.environ.get(name, default)
+
+# Process-wide Messages API client with connection pooling, timeouts and retries
+class LLMClient:
+    def __init__(self, base_url=LLM_BASE_URL, connect_timeout=LLM_CONNECT_TIMEOUT, read_timeout=LLM_READ_TIMEOUT,
+                 max_retries=LLM_MAX_RETRIES, backoff_seconds=LLM_BACKOFF_SECONDS,
+                 backoff_max_seconds=LLM_BACKOFF_MAX_SECONDS, pool_size=LLM_POOL_SIZE):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        # Keep-alive connections are reused across calls and sessions
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    # Seconds to wait before the next attempt, honoring retry-after when the server sends it
+    def retry_delay(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return min(self.backoff_max_seconds, max(0.0, float(retry_after)))
+            except ValueError:
+                try:
+                    return min(self.backoff_max_seconds, max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+                except (TypeError, ValueError):
+                    pass
+        delay = min(self.backoff_max_seconds, self.backoff_seconds * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.0)
+
+    def post(self, path, headers, body, stream=False):
+        url = f"{self.base_url}{path}"
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(url, headers=headers, json=body, timeout=self.timeout, stream=stream)
+            except requests.ConnectionError:
+                # Connection failures (including connect timeouts) never reached the model, so they are safe to retry
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay(attempt)
+            else:
+                if response.status_code not in LLM_RETRY_STATUSES or attempt == self.max_retries:
+                    return response
+                delay = self.retry_delay(attempt, response.headers.get("retry-after"))
+                response.close()
+            print(f"Retrying Claude request in {delay:.1f}s (attempt {attempt + 1} of {self.max_retries})")
+            time.sleep(delay)
+
+# Function to read a streamed Messages API response into the same shape as a non-streamed one
+def read_message_stream(response, on_text):
+    message = {"content": [], "usage": {}, "stop_reason": None}
+    # Tool inputs arrive as JSON fragments that only parse once their block is complete
+    partial_json = {}
+    # Server-sent events are UTF-8 regardless of the content-type charset
+    response.encoding = "utf-8"
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        data = json.loads(line[len("data:"):])
+        kind = data.get("type")
+        if kind == "message_start":
+            message["usage"].update(data["message"].get("usage", {}))
+        elif kind == "content_block_start":
+            message["content"].append(dict(data["content_block"]))
+        elif kind == "content_block_delta":
+            delta = data["delta"]
+            if delta.get("type") == "text_delta":
+                block = message["content"][data["index"]]
+                block["text"] = block.get("text", "") + delta["text"]
+                on_text(delta["text"])
+            elif delta.get("type") == "input_json_delta":
+                partial_json[data["index"]] = partial_json.get(data["index"], "") + delta["partial_json"]
+        elif kind == "content_block_stop":
+            if data["index"] in partial_json:
+                message["content"][data["index"]]["input"] = json.loads(partial_json.pop(data["index"]) or "{}")
+        elif kind == "message_delta":
+            message["stop_reason"] = data["delta"].get("stop_reason")
+            # Output tokens in the final usage event are cumulative
+            message["usage"].update(data.get("usage", {}))
+        elif kind == "error":
+            error = data.get("error", {})
+            raise RuntimeError(f"{error.get('type')} - {error.get('message')}")
+    return message
+
+# Coalesces concurrent calls with the same key into one in-flight call whose result they all share
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    # Returns (result, True) to the caller that ran fn and (result, False) to callers that waited on it
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self.calls[key] = call
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"], False
+        try:
+            call["result"] = fn()
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call["done"].set()
+        return call["result"], True
+
+# Function to create the process-wide request coalescer
+@st.cache_resource
+def get_single_flight():
+    return SingleFlight()
+
+# Function to create the shared LLM client once per process
+@st.cache_resource
+def get_llm_client():
+    return LLMClient(
+        base_url=get_setting("ANTHROPIC_BASE_URL", LLM_BASE_URL),
+        connect_timeout=float(get_setting("LLM_CONNECT_TIMEOUT", LLM_CONNECT_TIMEOUT)),
+        read_timeout=float(get_setting("LLM_READ_TIMEOUT", LLM_READ_TIMEOUT)),
+        max_retries=int(get_setting("LLM_MAX_RETRIES", LLM_MAX_RETRIES))
+    )
+
+# Disk-backed cache of Claude responses with TTL, size-bounded eviction and a dataset-version tag
+class ResponseCache:
+    def __init__(self, path=LLM_CACHE_PATH, ttl_seconds=LLM_CACHE_TTL_SECONDS,
+                 max_entries=LLM_CACHE_MAX_ENTRIES, max_bytes=LLM_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    dataset_version TEXT,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    # Hash of everything that determines the response
+    @staticmethod
+    def request_key(request_body):
+        payload = json.dumps(request_body, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key, dataset_version=None):
+        now = time.time()
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT response, dataset_version, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            response, version, created_at = row
+            if now - created_at > self.ttl_seconds or version != dataset_version:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            return response
+
+    def put(self, key, response, dataset_version=None):
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, dataset_version, response, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, dataset_version, response, now, now)
+            )
+            # Expired entries and entries from other dataset versions can never be served again
+            conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+            if dataset_version is not None:
+                conn.execute(
+                    "DELETE FROM responses WHERE dataset_version IS NOT NULL AND dataset_version != ?", (dataset_version,)
+                )
+            # Evict least recently used entries beyond the entry and byte bounds
+            conn.execute("""
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key,
+                               ROW_NUMBER() OVER (ORDER BY accessed_at DESC) AS position,
+                               SUM(LENGTH(response)) OVER (ORDER BY accessed_at DESC) AS running_bytes
+                        FROM responses
+                    ) WHERE position > ? OR running_bytes > ?
+                )
+            """, (self.max_entries, self.max_bytes))
+
+# Function to open the response cache once per process
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache()
+
+# Function to load the tokenizer bundled with the anthropic SDK; None falls back to a length estimate
+@st.cache_resource
+def get_tokenizer():
+    try:
+        from tokenizers import Tokenizer
+        return Tokenizer.from_file(os.path.join(os.path.dirname(anthropic.__file__), "tokenizer.json"))
+    except Exception as e:
+        print(f"Local tokenizer unavailable, estimating tokens from text length: {e}")
+        return None
+
+# Function to count the tokens in a piece of text
+def count_tokens(text):
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return -(-len(text) // 3)
+    return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+# Function to cut text down to at most max_tokens tokens
+def truncate_to_tokens(text, max_tokens):
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return text if len(text) <= max_tokens * 3 else text[:max_tokens * 3] + " [truncated]"
+    encoding = tokenizer.encode(text, add_special_tokens=False)
+    if len(encoding.ids) <= max_tokens:
+        return text
+    return text[:encoding.offsets[max_tokens - 1][1]] + " [truncated]"
+
+# Function to count the tokens of one chat message, including a small per-message overhead
+def count_message_tokens(message):
+    content = message["content"]
+    return 4 + count_tokens(content if isinstance(content, str) else json.dumps(content))
+
+# Function to keep a request within the input token cap by dropping the oldest history first
+def fit_messages_to_budget(system_texts, messages, max_tokens=MAX_INPUT_TOKENS, max_message_tokens=MAX_MESSAGE_TOKENS):
+    messages = [
+        {**m, "content": truncate_to_tokens(m["content"], max_message_tokens)} if isinstance(m["content"], str) else m
+        for m in messages
+    ]
+    system_tokens = sum(count_tokens(text) for text in system_texts)
+    sizes = [count_message_tokens(m) for m in messages]
+    while len(messages) > 1 and system_tokens + sum(sizes) > max_tokens:
+        messages, sizes = messages[1:], sizes[1:]
+        # The conversation has to start with a user turn
+        while len(messages) > 1 and messages[0]["role"] != "user":
+            messages, sizes = messages[1:], sizes[1:]
+    overflow = system_tokens + sum(sizes) - max_tokens
+    if overflow > 0 and isinstance(messages[-1]["content"], str):
+        remaining = max(1, sizes[-1] - overflow - 12)
+        messages[-1] = {**messages[-1], "content": truncate_to_tokens(messages[-1]["content"], remaining)}
+        sizes[-1] = count_message_tokens(messages[-1])
+    return messages, system_tokens + sum(sizes)
+
+# Function to look up a model's prices, falling back to the main model's for models not listed
+def model_prices(model):
+    return MODEL_PRICES.get(model, MODEL_PRICES[LLM_MODEL])
+
+# Function to compute the dollar cost of one response's usage at the prices of the model that produced it
+def usage_cost(model, usage):
+    prices = model_prices(model)
+    return ((usage.get("input_tokens") or 0) * prices["input"] +
+            (usage.get("output_tokens") or 0) * prices["output"] +
+            (usage.get("cache_creation_input_tokens") or 0) * prices["cache_write"] +
+            (usage.get("cache_read_input_tokens") or 0) * prices["cache_read"]) / 1000000
+
+# Function to return the dollar cost of the tokens used so far in this session
+def session_cost():
+    return st.session_state.get("total_cost", 0.0)
+
 # query_claude
-def query_claude(prompt, conversation_history=None, system_prompt=None):
+def query_claude(prompt, conversation_history=None, system_prompt=None, dataset_version=None, on_text=None,
+                 context_blocks=None, model=LLM_MODEL, max_tokens=LLM_MAX_OUTPUT_TOKENS,
+                 track_usage=True, use_cache=True, tools=None, run_tool=None):
+    # With on_text, the response is streamed and each text fragment is passed to on_text as it arrives.
+    # tools are offered to the model; run_tool(name, input) executes a call and returns its tool_result fields.
+    # context_blocks are per-request system texts sent after the cached system prompt.
+    # track_usage=False skips the per-session budget, for work done by background jobs outside any session.
+    # use_cache=False always asks Claude, but still stores the new answer.
     try:
         # Get API key and initialize session state for token tracking if needed
-        if "total_input_tokens" not in st.session_state:
-            st.session_state.total_input_tokens = 0
-        if "total_output_tokens" not in st.session_state:
-            st.session_state.total_output_tokens = 0
+        if track_usage:
+            for counter in ["total_input_tokens", "total_output_tokens", "total_cache_write_tokens", "total_cache_read_tokens", "total_cost"]:
+                if counter not in st.session_state:
+                    st.session_state[counter] = 0
             
-        # Calculate current approximate cost (based on claude-3-7-sonnet pricing)
-        input_cost_per_million = 3.00  # $3 per million input tokens
-        output_cost_per_million = 15.00  # $15 per million output tokens
+        # Prepare messages
+        messages = []
+        if conversation_history:
+            messages.extend(conversation_history)
         
-        current_cost = (st.session_state.total_input_tokens / 1000000 * input_cost_per_million) + \
-                      (st.session_state.total_output_tokens / 1000000 * output_cost_per_million)
+        messages.append({"role": "user", "content": prompt})
+        
+        if not system_prompt:
+            system_prompt = "You are Contamio, a food safety analysis assistant focused on analyzing food recall data in the USA."
+        context_blocks = [text for text in (context_blocks or []) if text]
         
-        # Estimate tokens in current prompt (rough estimation)
-        # A better approach would be to use a proper tokenizer
-        estimated_prompt_tokens = len(prompt) / 4  # Very rough estimate
+        # Count the whole request (system prompt, history and prompt) and trim it to the input cap
+        messages, estimated_prompt_tokens = fit_messages_to_budget([system_prompt] + context_blocks, messages)
+        
+        request_body = {
+            "model": model,
+            "max_tokens": max_tokens,
+            "messages": messages
+        }
         
-        # Check if adding this request would exceed our budget
-        max_budget_dollars = 1.00  # Maximum $1 per user session
+        # Mark the static system prompt as a cacheable prefix so repeated turns reuse it
+        request_body["system"] = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+        request_body["system"] += [{"type": "text", "text": text} for text in context_blocks]
+        if tools:
+            request_body["tools"] = tools
         
-        # Add estimated input cost
-        estimated_new_cost = current_cost + (estimated_prompt_tokens / 1000000 * input_cost_per_million)
+        # Identical requests are answered from the response cache without spending tokens
+        response_cache = get_response_cache()
+        cache_key = response_cache.request_key(request_body)
+        cached_response = response_cache.get(cache_key, dataset_version) if use_cache else None
+        if cached_response is not None:
+            if on_text is not None:
+                on_text(cached_response)
+            return cached_response
         
-        # If we're already over budget, return a message instead of calling API
-        if estimated_new_cost > max_budget_dollars:
-            return "You've reached the maximum usage limit for this session. Please start a new session or contact support."
+        if track_usage:
+            # Calculate current cost, each request priced by the model that served it
+            current_cost = session_cost()
+            
+            # Check if adding this request would exceed our budget
+            max_budget_dollars = 1.00  # Maximum $1 per user session
+            
+            # Add estimated input cost at this request's model prices
+            estimated_new_cost = current_cost + (estimated_prompt_tokens / 1000000 * model_prices(model)["input"])
+            
+            # If we're already over budget, return a message instead of calling API
+            if estimated_new_cost > max_budget_dollars:
+                return "You've reached the maximum usage limit for this session. Please start a new session or contact support."
             
         # Continue with regular API call if we're within budget
         if "CLAUDE_API_KEY" in st.secrets:
@@ -187,79 +2336,417 @@ def query_claude(prompt, conversation_history=None, system_prompt=None):
             "content-type": "application/json"
         }
         
-        # Prepare messages
-        messages = []
-        if conversation_history:
-            messages.extend(conversation_history)
+        def send_message(body):
+            if on_text is not None:
+                response = get_llm_client().post("/v1/messages", headers, {**body, "stream": True}, stream=True)
+            else:
+                response = get_llm_client().post("/v1/messages", headers, body)
+            if response.status_code != 200:
+                return f"API Error: {response.status_code} - {response.text}"
+            if on_text is not None:
+                with response:
+                    return read_message_stream(response, on_text)
+            return response.json()
         
-        messages.append({"role": "user", "content": prompt})
+        # Answer tool calls locally and send the results back until the model gives its final answer
+        def send_request():
+            conversation = list(request_body["messages"])
+            texts, usage = [], {}
+            for round_number in range(LLM_MAX_TOOL_ROUNDS + 1):
+                body = {**request_body, "messages": conversation}
+                if tools and round_number == LLM_MAX_TOOL_ROUNDS:
+                    # Out of tool rounds, so the model has to answer with the results it already has
+                    body["tool_choice"] = {"type": "none"}
+                if texts and on_text is not None:
+                    on_text("\n\n")
+                message = send_message(body)
+                if isinstance(message, str):
+                    return message
+                for key, value in message.get("usage", {}).items():
+                    if isinstance(value, int):
+                        usage[key] = usage.get(key, 0) + value
+                text = "".join(block.get("text", "") for block in message["content"] if block.get("type") == "text")
+                if text:
+                    texts.append(text)
+                tool_calls = [block for block in message["content"] if block.get("type") == "tool_use"]
+                if message.get("stop_reason") != "tool_use" or not tool_calls or run_tool is None:
+                    break
+                conversation.append({
+                    "role": "assistant",
+                    "content": [block for block in message["content"] if block.get("type") != "text" or block.get("text")]
+                })
+                conversation.append({
+                    "role": "user",
+                    "content": [
+                        {"type": "tool_result", "tool_use_id": call["id"], **run_tool(call["name"], call.get("input") or {})}
+                        for call in tool_calls
+                    ]
+                })
+            return {"content": [{"type": "text", "text": "\n\n".join(texts)}], "usage": usage}
         
-        request_body = {
-            "model": "claude-3-7-sonnet-20250219",
-            "max_tokens": 1500,
-            "messages": messages
-        }
+        # Concurrent identical requests share one API call; only its caller is billed
+        result, is_leader = get_single_flight().do(cache_key, send_request)
         
-        if system_prompt:
-            request_body["system"] = system_prompt
-        else:
-            request_body["system"] = "You are Contamio, a food safety analysis assistant focused on analyzing food recall data in the USA."
+        if isinstance(result, str):
+            return result
         
-        import requests
-        response = requests.post(
-            "https://api.anthropic.com/v1/messages",
-            headers=headers,
-            json=request_body
-        )
+        response_data = result
+        response_text = "".join(block.get("text", "") for block in response_data["content"] if block.get("type") == "text")
+        if not is_leader:
+            if on_text is not None:
+                on_text(response_text)
+            return response_text
         
-        if response.status_code == 200:
-            response_data = response.json()
+        # Update token counters
+        if not track_usage:
+            print(f"Background request usage: {response_data.get('usage', {})}")
+        elif "usage" in response_data:
+            # Update input tokens
+            input_tokens = response_data["usage"].get("input_tokens", 0)
+            st.session_state.total_input_tokens += input_tokens
             
-            # Update token counters
-            if "usage" in response_data:
-                # Update input tokens
-                input_tokens = response_data["usage"].get("input_tokens", 0)
-                st.session_state.total_input_tokens += input_tokens
-                
-                # Update output tokens
-                output_tokens = response_data["usage"].get("output_tokens", 0)
-                st.session_state.total_output_tokens += output_tokens
-                
-                # Calculate and store updated cost
-                updated_cost = (st.session_state.total_input_tokens / 1000000 * input_cost_per_million) + \
-                              (st.session_state.total_output_tokens / 1000000 * output_cost_per_million)
-                st.session_state.current_session_cost = updated_cost
-                
-                # Optionally show cost to admin or log it
-                print(f"Session cost so far: ${updated_cost:.4f}")
+            # Update output tokens
+            output_tokens = response_data["usage"].get("output_tokens", 0)
+            st.session_state.total_output_tokens += output_tokens
             
-            return response_data["content"][0]["text"]
-        else:
-            return f"API Error: {response.status_code} - {response.text}"
+            # Prompt cache writes and reads are billed separately from regular input tokens
+            st.session_state.total_cache_write_tokens += response_data["usage"].get("cache_creation_input_tokens") or 0
+            st.session_state.total_cache_read_tokens += response_data["usage"].get("cache_read_input_tokens") or 0
+            
+            # Price the usage by the model actually called, so summaries are charged at the summary model's rates
+            st.session_state.total_cost += usage_cost(model, response_data["usage"])
+            
+            # Calculate and store updated cost
+            updated_cost = session_cost()
+            st.session_state.current_session_cost = updated_cost
+            
+            # Optionally show cost to admin or log it
+            print(f"Session cost so far: ${updated_cost:.4f}")
+        
+        if response_text:
+            response_cache.put(cache_key, response_text, dataset_version)
+        return response_text
     except Exception as e:
         return f"Error: {str(e)}"
         
-# Function to generate food recall insights
-def generate_insights(df, aspect):
-    if df.empty:
-        return "No data available to analyze."
-    
-    # Create a context message with data statistics
-    data_context = f"""
-    Based on the food recall dataset with {len(df)} recalls:
-    
+# Disk-backed store of chat turns moved out of session memory, one sequence per chat session
+class ChatStore:
+    def __init__(self, path=CHAT_STORE_PATH, ttl_seconds=CHAT_STORE_TTL_SECONDS):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    session_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (session_id, position)
+                )
+            """)
+            # Sessions idle for longer than the TTL are gone for good
+            conn.execute("DELETE FROM messages WHERE created_at < ?", (time.time() - ttl_seconds,))
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    # Store messages as positions start, start + 1, ... of the session
+    def append(self, session_id, start, messages):
+        now = time.time()
+        with self.connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO messages (session_id, position, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(session_id, start + i, m["role"], m["content"], now) for i, m in enumerate(messages)]
+            )
+
+    # Up to limit messages immediately before position, oldest first
+    def load(self, session_id, before, limit):
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT role, content FROM messages WHERE session_id = ? AND position < ? ORDER BY position DESC LIMIT ?",
+                (session_id, before, limit)
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+# Function to open the chat store once per process
+@st.cache_resource
+def get_chat_store():
+    return ChatStore()
+
+# Function to move the oldest summarized turns out of session memory once the in-memory history is full
+def spill_chat_history():
+    messages = st.session_state.messages
+    offset = st.session_state.get("messages_offset", 0)
+    # Only turns already folded into the chat memory can leave, so the next request loses nothing
+    count = min(len(messages) - CHAT_MAX_MESSAGES_IN_MEMORY, st.session_state.get("summarized_upto", 0) - offset)
+    if count <= 0:
+        return
+    if "chat_session_id" not in st.session_state:
+        st.session_state.chat_session_id = uuid.uuid4().hex
+    get_chat_store().append(st.session_state.chat_session_id, offset, messages[:count])
+    # Loaded turns cover positions earlier_start..offset; spilled turns join them so the transcript stays
+    # one contiguous range, dropping the oldest loaded turns past the cap
+    earlier = st.session_state.get("earlier_messages", [])
+    if earlier:
+        earlier = earlier + messages[:count]
+        drop = max(0, len(earlier) - CHAT_MAX_EARLIER_MESSAGES)
+        st.session_state.earlier_messages = earlier[drop:]
+        st.session_state.earlier_start += drop
+    st.session_state.messages = messages[count:]
+    st.session_state.messages_offset = offset + count
+
+# Function to render one chat message as HTML, once per message
+def message_html(message):
+    if "html" not in message:
+        role_class = "user" if message["role"] == "user" else "assistant"
+        message["html"] = f'<div class="message-row {role_class}"><div class="message {role_class}">{message["content"]}</div></div>'
+    return message["html"]
+
+# Function to describe the local recall query tool, with the valid values of each filter column
+@st.cache_data(max_entries=4)
+def build_chat_tools(_df, dataset_version):
+    index = get_filter_index(_df, dataset_version, tuple(TOOL_FILTER_COLUMNS))
+    filter_properties = {}
+    for col in TOOL_FILTER_COLUMNS:
+        values = [str(value) for value in index.values(col)]
+        if not values:
+            continue
+        items = {"type": "string"}
+        if len(values) <= TOOL_ENUM_MAX_VALUES:
+            items["enum"] = values
+        filter_properties[col] = {"type": "array", "items": items}
+    return [{
+        "name": "query_recalls",
+        "description": (
+            "Run an exact query over the food recall database. Filters keep recalls matching any listed value "
+            "within a column and all filtered columns. 'count' returns the number of matching recalls, 'top' ranks "
+            "the values of group_by by recall count, and 'time_series' counts matching recalls per year or month."
+        ),
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "operation": {"type": "string", "enum": ["count", "top", "time_series"]},
+                "filters": {"type": "object", "properties": filter_properties, "additionalProperties": False},
+                "year_from": {"type": "integer", "description": "First year to include"},
+                "year_to": {"type": "integer", "description": "Last year to include"},
+                "search": {"type": "string", "description": "Text that must appear in the product description, firm name or recall reason"},
+                "group_by": {"type": "string", "enum": TOOL_GROUP_COLUMNS, "description": "Column to rank for 'top'"},
+                "limit": {"type": "integer", "minimum": 1, "maximum": TOOL_MAX_ROWS, "description": "Rows to return for 'top'"},
+                "interval": {"type": "string", "enum": ["year", "month"], "description": "Bucket size for 'time_series'"}
+            },
+            "required": ["operation"]
+        }
+    }]
+
+# Function to run one query_recalls call against the recall frame; raises ValueError for invalid input
+def run_recall_query(df, dataset_version, params):
+    index = get_filter_index(df, dataset_version, tuple(TOOL_FILTER_COLUMNS))
+    filters = {}
+    for col, values in (params.get("filters") or {}).items():
+        if col not in TOOL_FILTER_COLUMNS:
+            raise ValueError(f"Unknown filter column '{col}'. Filterable columns: {', '.join(TOOL_FILTER_COLUMNS)}")
+        # Match values case-insensitively against the stored values
+        known = {str(value).lower(): value for value in index.values(col)}
+        values = values if isinstance(values, list) else [values]
+        unknown = [value for value in values if str(value).lower() not in known]
+        if unknown:
+            raise ValueError(f"Unknown {col} value(s): {unknown}. Valid values: {list(known.values())[:TOOL_ENUM_MAX_VALUES]}")
+        filters[col] = [known[str(value).lower()] for value in values]
+    if params.get("year_from") is not None or params.get("year_to") is not None:
+        year_from = int(params.get("year_from") or -10 ** 6)
+        year_to = int(params.get("year_to") or 10 ** 6)
+        years = [year for year in filters.get("Year", index.values("Year")) if year_from <= int(year) <= year_to]
+        filters["Year"] = years or [None]
+    positions = index.select(filters)
+    if params.get("search"):
+        positions = get_search_index(df, dataset_version).search(str(params["search"]), positions)
+
+    operation = params.get("operation", "count")
+    result = {"matching_recalls": int(len(positions))}
+    if operation == "top":
+        col = params.get("group_by")
+        if col not in TOOL_GROUP_COLUMNS:
+            raise ValueError(f"group_by must be one of: {', '.join(TOOL_GROUP_COLUMNS)}")
+        if col == "State":
+            counts = state_counts(df["State Mask"].to_numpy()[positions]) if "State Mask" in df.columns else pd.Series(dtype=int)
+        else:
+            counts = observed_counts(df[col].take(positions))
+        limit = min(max(int(params.get("limit") or 10), 1), TOOL_MAX_ROWS)
+        result["group_by"] = col
+        result["distinct_values"] = int(len(counts))
+        result["top"] = [{"value": str(value), "count": int(count)} for value, count in counts.head(limit).items()]
+    elif operation == "time_series":
+        interval = params.get("interval") or "year"
+        if interval == "month":
+            # Count on the integer period keys and format only the distinct periods
+            counts = df["Period"].take(positions).value_counts().sort_index()
+            labels = [f"{period // 12}-{period % 12 + 1:02d}" for period in counts.index.to_numpy(dtype=np.int64)]
+        else:
+            counts = df["Year"].take(positions).value_counts().sort_index()
+            labels = [str(year) for year in counts.index]
+        result["interval"] = interval
+        result["series"] = [{"period": label, "count": int(count)} for label, count in zip(labels, counts.to_numpy())]
+    elif operation != "count":
+        raise ValueError("operation must be one of: count, top, time_series")
+    return result
+
+# Function to create the process-wide cache of tool results
+@st.cache_resource
+def get_tool_cache():
+    return LRUCache(TOOL_CACHE_MAX_ENTRIES, TOOL_CACHE_MAX_BYTES)
+
+# Function to execute a chat tool call, returning the tool_result fields; results are cached per dataset version
+def run_chat_tool(df, dataset_version, name, params):
+    key = hashlib.sha256(json.dumps([dataset_version, name, params], sort_keys=True, default=str).encode()).hexdigest()
+    cached = get_tool_cache().get(key)
+    if cached is not None:
+        return cached
+    try:
+        if name != "query_recalls":
+            raise ValueError(f"Unknown tool '{name}'")
+        result = {"content": json.dumps(run_recall_query(df, dataset_version, params))}
+    except (ValueError, TypeError, KeyError) as e:
+        return {"content": f"Invalid query: {e}", "is_error": True}
+    get_tool_cache().put(key, result)
+    return result
+
+# Function to build the chat system prompt once per dataset version
+@st.cache_data(max_entries=4)
+def build_chat_system_prompt(_df, dataset_version):
+    df = _df
+    return f"""
+            You are Contamio, a real-time data-driven food risk analyst.
+            Primary purpose: Provide concise, data-focused insights for dynamic HACCP decision-making.
+            
+            Response guidelines:
+            1. Keep responses brief and direct - prioritize facts over explanations
+            2. Lead with specific numbers, percentages, and statistical findings
+            3. Integrate testing recommendations naturally within your points
+            4. Focus only on actionable insights that inform immediate testing decisions
+
+
+            DATABASE CONTEXT:
+            - You have access to a food recall database with {len(df)} records.
+            - The database includes information about product types, companies, recall reasons, and dates.
+            - Top food categories: {', '.join(observed_counts(df['Food Category']).head(5).index.tolist())}
+            - Common recall reasons: {', '.join(observed_counts(df['Recall Category']).head(5).index.tolist())}
+            - Years covered: {df['Year'].min()} to {df['Year'].max()}
+            - Most frequent contaminants: {', '.join(observed_counts(df[df['Recall Category'] == 'Microbial Contamination']['Detailed Recall Category']).head(3).index.tolist()) if 'Microbial Contamination' in df['Recall Category'].values else 'varies'}
+            - Seasonal patterns: {df['Season'].value_counts().index[0]} shows highest recall rates
+            - Top allergens: {', '.join(observed_counts(df[df['Recall Category'] == 'Allergen Issues']['Detailed Recall Category']).head(3).index.tolist()) if 'Allergen Issues' in df['Recall Category'].values else 'varies'}
+            - For exact counts, rankings and trends, call the query_recalls tool instead of estimating from the figures above
+
+
+            
+            Response format:
+            * Bold headline summarizing key risk (3-5 words)
+            * 2-3 concise bullet points with specific data
+            * Integrate testing priorities directly into relevant points
+            * Total response should be under 10 lines when possible
+
+             Analytical focus:
+             - Highlight seasonal variations relevant to current time period
+             - Identify correlations between product types and specific contaminants
+             - Prioritize Class I (severe) recall risks over less critical issues
+             - Connect data points to specific testing recommendations
+              If the user writes in Hebrew, reply in Hebrew. Otherwise, reply in English.
+              """
+
+# Function to fold older chat turns into the running memory with a small summarization call
+def summarize_turns(memory, turns, dataset_version=None):
+    transcript = "\n".join(f"{turn['role'].upper()}: {turn['content']}" for turn in turns)
+    prompt = f"""Update the running memory of a conversation between a user and Contamio, a food recall analysis assistant.
+Keep facts, numbers, products, contaminants, dates, decisions and user preferences that may matter later. Drop greetings and filler.
+Reply with the updated memory only, in at most 200 words.
+
+Current memory:
+{memory or "(empty)"}
+
+New turns:
+{transcript}"""
+    summary = query_claude(
+        prompt,
+        system_prompt="You maintain compact, factual conversation memories.",
+        dataset_version=dataset_version,
+        model=SUMMARY_MODEL,
+        max_tokens=SUMMARY_MAX_TOKENS
+    )
+    if summary.startswith(QUERY_ERROR_PREFIXES):
+        return None
+    return summary.strip()
+
+# Function to split chat history into a rolling memory plus the newest turns that fit the history budget
+def compact_conversation(history, dataset_version=None):
+    # history holds the in-memory turns; summarized_upto counts from the first turn of the session
+    offset = st.session_state.get("messages_offset", 0)
+    memory = st.session_state.get("chat_memory", "")
+    start = st.session_state.get("summarized_upto", 0) - offset
+    recent = history[start:]
+
+    # Walk back from the newest turn until the verbatim budget is used up
+    split = len(recent)
+    kept_tokens = 0
+    while split > 0:
+        size = count_message_tokens(recent[split - 1])
+        if kept_tokens + size > HISTORY_TOKEN_BUDGET:
+            break
+        kept_tokens += size
+        split -= 1
+
+    older, recent = recent[:split], recent[split:]
+    # Summarize in chunks small enough to fit one prompt; each chunk builds on the memory so far
+    chunk_budget = MAX_MESSAGE_TOKENS - count_tokens(memory) - 500
+    while older:
+        size = 0
+        end = 0
+        while end < len(older) and (end == 0 or size + count_message_tokens(older[end]) <= chunk_budget):
+            size += count_message_tokens(older[end])
+            end += 1
+        summary = summarize_turns(memory, older[:end], dataset_version)
+        # If summarizing fails the remaining turns are left out this time and retried on the next turn
+        if summary is None:
+            break
+        memory = summary
+        start += end
+        older = older[end:]
+        st.session_state.chat_memory = memory
+        st.session_state.summarized_upto = offset + start
+        chunk_budget = MAX_MESSAGE_TOKENS - count_tokens(memory) - 500
+
+    # The request has to start with a user turn
+    while recent and recent[0]["role"] != "user":
+        recent = recent[1:]
+    return recent, memory
+
+# Function to generate food recall insights
+def generate_insights(df, aspect, track_usage=True, use_cache=True):
+    if df.empty:
+        return "No data available to analyze."
+    
+    # Flagged spikes and level shifts, shared with the dashboard when it already analyzed this version
+    version = df.attrs.get("dataset_version")
+    trend_context = get_trend_tracker().analyze(version, lambda: frame_series_counts(df)).context()
+    
+    # Create a context message with data statistics
+    data_context = f"""
+    Based on the food recall dataset with {len(df)} recalls:
+    
     Top reasons for recalls:
     {df['Reason for Recall'].value_counts().head(5).to_dict()}
     
     Top food categories:
-    {df['Food Category'].value_counts().head(5).to_dict()}
+    {observed_counts(df['Food Category']).head(5).to_dict()}
     
     Years covered: {df['Year'].min()} to {df['Year'].max()}
+    
+    {trend_context}
     """
     
     # Specific insights based on the aspect requested
     if aspect == "trends":
-        prompt = f"{data_context}\n\nAnalyze the main trends in food recalls over time. What patterns emerge in terms of frequency, types of recalls, or seasonal variations? Please provide 3-5 key insights."
+        prompt = f"{data_context}\n\nAnalyze the main trends in food recalls over time. What patterns emerge in terms of frequency, types of recalls, or seasonal variations? Ground the answer in the flagged months and trends above, quoting their figures. Please provide 3-5 key insights."
     elif aspect == "allergens":
         prompt = f"{data_context}\n\nAnalyze allergen-related recalls in the dataset. What are the most common allergens missing from labels? Which food categories are most affected? Please provide 3-5 key insights about allergen-related recalls."
     elif aspect == "contaminants":
@@ -269,175 +2756,222 @@ def generate_insights(df, aspect):
     else:
         prompt = f"{data_context}\n\nProvide an overall analysis of the food recall data. What are the most important patterns and insights that would be valuable for food safety professionals and consumers? Please provide 5-7 key insights."
     
-    return query_claude(prompt)
+    return query_claude(prompt, dataset_version=version, track_usage=track_usage, use_cache=use_cache)
 
-# Main application
-def main():
-    display_logo()
-    
-    # Load data
-    df = load_data()
-    
-    if df.empty:
-        st.warning("No data loaded. Please check your Excel file.")
-        return
+# Runs insight generation for every aspect in a thread pool and keeps the latest result per dataset version
+class InsightsRunner:
+    def __init__(self, max_workers=INSIGHTS_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="insights")
+        self.lock = threading.Lock()
+        self.results = {}
+        self.pending = {}
+
+    # Start every aspect that has no result yet for this dataset version, or whose failed result is due for a retry
+    def ensure(self, df):
+        version = df.attrs.get("dataset_version")
+        now = time.time()
+        with self.lock:
+            # Results for other dataset versions are stale
+            for key in [key for key in self.results if key[0] != version]:
+                del self.results[key]
+            missing = [aspect for aspect in INSIGHT_ASPECTS.values()
+                       if (version, aspect) not in self.pending
+                       and ((version, aspect) not in self.results or now >= self.results[(version, aspect)]["retry_at"])]
+        self.submit(df, missing, use_cache=True)
+
+    # Regenerate the given aspects in the background, bypassing cached answers; returns their futures by aspect
+    def refresh(self, df, aspects=None):
+        return self.submit(df, aspects or list(INSIGHT_ASPECTS.values()), use_cache=False)
+
+    # Start the aspects not already running and return the future of every requested aspect, so callers can wait
+    # on it even after a fast job has left self.pending
+    def submit(self, df, aspects, use_cache):
+        version = df.attrs.get("dataset_version")
+        futures = {}
+        with self.lock:
+            for aspect in aspects:
+                if (version, aspect) not in self.pending:
+                    self.pending[(version, aspect)] = self.executor.submit(self.run, df, version, aspect, use_cache)
+                futures[aspect] = self.pending[(version, aspect)]
+        return futures
+
+    def run(self, df, version, aspect, use_cache):
+        try:
+            text = generate_insights(df, aspect, track_usage=False, use_cache=use_cache)
+        except Exception as e:
+            text = f"Error: {str(e)}"
+        error = text.startswith(QUERY_ERROR_PREFIXES)
+        with self.lock:
+            previous = self.results.get((version, aspect))
+            failures = previous["failures"] + 1 if error and previous is not None and previous["error"] else int(error)
+            self.results[(version, aspect)] = {
+                "text": text,
+                "generated_at": datetime.now(),
+                "error": error,
+                "failures": failures,
+                # Successful results stay until the dataset version changes
+                "retry_at": time.time() + min(INSIGHTS_RETRY_SECONDS * 2 ** (failures - 1), INSIGHTS_RETRY_MAX_SECONDS)
+                            if error else float("inf")
+            }
+            self.pending.pop((version, aspect), None)
+        return text
+
+    def get(self, version, aspect):
+        with self.lock:
+            return self.results.get((version, aspect))
+
+    def future(self, version, aspect):
+        with self.lock:
+            return self.pending.get((version, aspect))
+
+# Function to create the process-wide insights runner
+@st.cache_resource
+def get_insights_runner():
+    return InsightsRunner()
+
+# Function to draw the sidebar filters and return the selected values per column
+def render_filters(backend):
+    # Load and process data for dashboard
+    if "selected_filter" not in st.session_state:
+        st.session_state.selected_filter = None
         
-    # Create tabs for different sections
-    tabs = st.tabs(["📊 Dashboard", "💬 Ask Contamio", "📈 Insights", "ℹ️ About"])
-    
-    # Dashboard Tab
-    with tabs[0]:
-        st.header("Food Recall Dashboard")
-    
-        # Load and process data for dashboard
-        if "filtered_data" not in st.session_state:
-            st.session_state.filtered_data = df.copy()
-            st.session_state.selected_filter = None
-            
-        # Add filters sidebar
-        st.sidebar.header("Filters")
-    
-        # Year filter
-        available_years = sorted(df["Year"].dropna().unique().tolist())
-        selected_years = st.sidebar.multiselect(
-            "Select Years", 
-            available_years,
-            default=available_years
-        )
-    
-        # Month filter (NEW)
-        all_months = ["January", "February", "March", "April", "May", "June", 
-                     "July", "August", "September", "October", "November", "December"]
-        available_months = [month for month in all_months if month in df["Month Name"].unique()]
-        selected_months = st.sidebar.multiselect(
-            "Select Months",
-            available_months,
-            default=[]
-        )
-    
-        # Filter for food categories (NEW)
-        food_categories = sorted(df["Food Category"].dropna().unique().tolist())
-        selected_food_categories = st.sidebar.multiselect(
-            "Food Categories",
-            food_categories,
-            default=[]
-        )
-    
-        # Filter for common recall reasons
-        top_reasons = df["Recall Category"].value_counts().head(10).index.tolist()
-        selected_reason = st.sidebar.multiselect(
-            "Recall Category",
-            top_reasons,
-            default=[]
-        )
-    
-        # Filter for common contaminants
-        contaminants = df[df["Recall Category"] == "Microbial Contamination"]["Detailed Recall Category"].value_counts().head(10).index.tolist()
-        selected_contaminant = st.sidebar.multiselect(
-            "Contaminant Type",
-            contaminants,
-            default=[]
-        )
+    # Add filters sidebar
+    st.sidebar.header("Filters")
+
+    # Year filter
+    available_years = backend.distinct("Year")
+    selected_years = st.sidebar.multiselect(
+        "Select Years", 
+        available_years,
+        default=available_years
+    )
+
+    # Month filter (NEW)
+    available_months = [month for month in MONTH_NAMES if month in backend.distinct("Month Name")]
+    selected_months = st.sidebar.multiselect(
+        "Select Months",
+        available_months,
+        default=[]
+    )
+
+    # Filter for food categories (NEW)
+    food_categories = backend.distinct("Food Category")
+    selected_food_categories = st.sidebar.multiselect(
+        "Food Categories",
+        food_categories,
+        default=[]
+    )
+
+    # Filter for common recall reasons
+    top_reasons = backend.top_values("Recall Category", 10)
+    selected_reason = st.sidebar.multiselect(
+        "Recall Category",
+        top_reasons,
+        default=[]
+    )
+
+    # Filter for common contaminants
+    contaminants = backend.top_values("Detailed Recall Category", 10, {"Recall Category": ["Microbial Contamination"]})
+    selected_contaminant = st.sidebar.multiselect(
+        "Contaminant Type",
+        contaminants,
+        default=[]
+    )
+
+    return {
+        "Year": selected_years,
+        "Month Name": selected_months,
+        "Food Category": selected_food_categories,
+        "Recall Category": selected_reason,
+        "Detailed Recall Category": selected_contaminant
+    }
+
+# Function to draw the dashboard metrics and charts for the selected filters
+def render_dashboard(backend, selected_filters):
+    st.header("Food Recall Dashboard")
+
+    # Aggregates for this filter state are shared across sessions and reruns; the session keeps only its filters
+    filter_key = filter_state_key(selected_filters, backend.version)
+    aggregates = get_aggregation_cache().get_or_compute(filter_key, lambda: backend.aggregates(selected_filters))
+    # Spikes and level shifts of every recall category x food category series, narrowed to the filters
+    trends = get_trend_tracker().analyze(backend.version, backend.series_counts)
+    anomalies = TrendAnalysis.filter_anomalies(trends.anomalies(), selected_filters)
     
-        # Apply filters to data
-        filtered_data = df.copy()
-        if selected_years:
-            filtered_data = filtered_data[filtered_data["Year"].isin(selected_years)]
-        if selected_months:
-            filtered_data = filtered_data[filtered_data["Month Name"].isin(selected_months)]
-        if selected_food_categories:
-            filtered_data = filtered_data[filtered_data["Food Category"].isin(selected_food_categories)]
-        if selected_reason:
-            filtered_data = filtered_data[filtered_data["Recall Category"].isin(selected_reason)]
-        if selected_contaminant:
-            filtered_data = filtered_data[filtered_data["Detailed Recall Category"].isin(selected_contaminant)]
-    
-        # Update session state
-        st.session_state.filtered_data = filtered_data
-        
-        # Summary metrics in a nice grid with colored cards
-        st.markdown("""
-        <style>
-        .metric-card {
-            background-color: white;
-            border-radius: 10px;
-            padding: 20px 10px;
-            text-align: center;
-            box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-            transition: transform 0.3s ease;
-        }
-        .metric-card:hover {
-            transform: translateY(-5px);
-        }
-        .metric-value {
-            font-size: 2.2rem;
-            font-weight: bold;
-            color: #00a3e0;
-            margin-bottom: 5px;
-        }
-        .metric-label {
-            font-size: 1rem;
-            color: #555;
-        }
-        </style>
+    # Summary metrics in a nice grid with colored cards
+    st.markdown("""
+    <style>
+    .metric-card {
+        background-color: white;
+        border-radius: 10px;
+        padding: 20px 10px;
+        text-align: center;
+        box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
+        transition: transform 0.3s ease;
+    }
+    .metric-card:hover {
+        transform: translateY(-5px);
+    }
+    .metric-value {
+        font-size: 2.2rem;
+        font-weight: bold;
+        color: #00a3e0;
+        margin-bottom: 5px;
+    }
+    .metric-label {
+        font-size: 1rem;
+        color: #555;
+    }
+    </style>
+    """, unsafe_allow_html=True)
+
+    col1, col2, col3, col4 = st.columns(4)
+
+    with col1:
+        st.markdown(f"""
+        <div class="metric-card">
+            <div class="metric-value">{aggregates["total"]:,}</div>
+            <div class="metric-label">Total Recalls</div>
+        </div>
+        """, unsafe_allow_html=True)
+
+    with col2:
+        st.markdown(f"""
+        <div class="metric-card">
+            <div class="metric-value">{aggregates["unique_companies"]:,}</div>
+            <div class="metric-label">Unique Companies</div>
+        </div>
         """, unsafe_allow_html=True)
     
-        col1, col2, col3, col4 = st.columns(4)
+    with col3:
+        st.markdown(f"""
+        <div class="metric-card">
+            <div class="metric-value">{aggregates["food_category_count"]:,}</div>
+            <div class="metric-label">Food Categories</div>
+        </div>
+        """, unsafe_allow_html=True)
     
-        with col1:
-            st.markdown(f"""
-            <div class="metric-card">
-                <div class="metric-value">{len(filtered_data):,}</div>
-                <div class="metric-label">Total Recalls</div>
-            </div>
-            """, unsafe_allow_html=True)
+    with col4:
+        affected_states = aggregates["affected_states"]
     
-        with col2:
-            st.markdown(f"""
-            <div class="metric-card">
-                <div class="metric-value">{filtered_data["Recalling Firm Name"].nunique():,}</div>
-                <div class="metric-label">Unique Companies</div>
-            </div>
-            """, unsafe_allow_html=True)
-        
-        with col3:
-            st.markdown(f"""
-            <div class="metric-card">
-                <div class="metric-value">{filtered_data["Food Category"].nunique():,}</div>
-                <div class="metric-label">Food Categories</div>
-            </div>
-            """, unsafe_allow_html=True)
-        
-        with col4:
-            affected_states = 0
-            if "Distribution Pattern" in filtered_data.columns:
-                # Count unique states mentioned in distribution patterns
-                all_states = []
-                for pattern in filtered_data["Distribution Pattern"].dropna():
-                    if isinstance(pattern, str):
-                        states = [s.strip() for s in pattern.split(",") if len(s.strip()) == 2]
-                        all_states.extend(states)
-                affected_states = len(set(all_states))
-        
-            st.markdown(f"""
-            <div class="metric-card">
-                <div class="metric-value">{affected_states if affected_states > 0 else 'N/A'}</div>
-                <div class="metric-label">Affected States</div>
-            </div>
-            """, unsafe_allow_html=True)
-    
-        # Main visualizations section
-        st.subheader("Recall Analysis")
-    
-        # Create two columns for the charts
-        viz_col1, viz_col2 = st.columns(2)
-    
-        with viz_col1:
-            # Recall Categories Chart (clickable)
-            if "Recall Category" in filtered_data.columns:
-                top_categories = filtered_data["Recall Category"].value_counts().head(10).reset_index()
-                top_categories.columns = ["Category", "Count"]
-            
+        st.markdown(f"""
+        <div class="metric-card">
+            <div class="metric-value">{affected_states if affected_states > 0 else 'N/A'}</div>
+            <div class="metric-label">Affected States</div>
+        </div>
+        """, unsafe_allow_html=True)
+
+    # Main visualizations section
+    st.subheader("Recall Analysis")
+
+    # Create two columns for the charts
+    viz_col1, viz_col2 = st.columns(2)
+
+    with viz_col1:
+        # Recall Categories Chart (clickable)
+        if aggregates["recall_categories"] is not None:
+            top_categories = aggregates["recall_categories"]
+        
+            def build_figure():
                 fig = px.bar(
                     top_categories, 
                     x="Count", 
@@ -451,22 +2985,24 @@ def main():
                     height=400,
                     clickmode='event+select'
                 )
-            
-                # Make chart interactive
-                selected_points = plotly_chart(fig, key="recall_categories_chart", use_container_width=True)
-            
-                # Process clicks on the chart
-                if selected_points:
-                    selected_category = top_categories.iloc[selected_points["points"][0]["pointIndex"]]["Category"]
-                    st.session_state.selected_filter = ("Recall Category", selected_category)
-                    st.experimental_rerun()
-    
-        with viz_col2:
-            # Detailed Recall Categories Chart (clickable)
-            if "Detailed Recall Category" in filtered_data.columns:
-                detailed_categories = filtered_data["Detailed Recall Category"].value_counts().head(10).reset_index()
-                detailed_categories.columns = ["Category", "Count"]
-            
+                return fig
+            fig = cached_figure("recall_categories_chart", filter_key, build_figure)
+        
+            # Make chart interactive
+            selected_points = plotly_chart(fig, key="recall_categories_chart", use_container_width=True)
+        
+            # Process clicks on the chart
+            if selected_points:
+                selected_category = top_categories.iloc[selected_points["points"][0]["pointIndex"]]["Category"]
+                st.session_state.selected_filter = ("Recall Category", selected_category)
+                st.rerun()
+
+    with viz_col2:
+        # Detailed Recall Categories Chart (clickable)
+        if aggregates["detailed_categories"] is not None:
+            detailed_categories = aggregates["detailed_categories"]
+        
+            def build_figure():
                 fig = px.bar(
                     detailed_categories, 
                     x="Count", 
@@ -480,62 +3016,50 @@ def main():
                     height=400,
                     clickmode='event+select'
                 )
-            
-                # Make chart interactive
-                selected_points = plotly_chart(fig, key="detailed_categories_chart", use_container_width=True)
-            
-                # Process clicks on the chart
-                if selected_points:
-                    selected_category = detailed_categories.iloc[selected_points["points"][0]["pointIndex"]]["Category"]
-                    st.session_state.selected_filter = ("Detailed Recall Category", selected_category)
-                    st.experimental_rerun()
-    
-        # Monthly breakdown chart (NEW)
-        st.subheader("Monthly Analysis")
-    
-        # Create a monthly breakdown chart
-        if "Month Name" in filtered_data.columns:
-            # Create month order mapping
-            month_order = {
-                "January": 1, "February": 2, "March": 3, "April": 4,
-                "May": 5, "June": 6, "July": 7, "August": 8,
-                "September": 9, "October": 10, "November": 11, "December": 12
-            }
-        
-            # Create a temporary column for sorting
-            filtered_data_with_order = filtered_data.copy()
-            filtered_data_with_order["MonthOrder"] = filtered_data_with_order["Month Name"].map(month_order)
+                return fig
+            fig = cached_figure("detailed_categories_chart", filter_key, build_figure)
         
-            # Group by month and count recalls
-            month_data = filtered_data_with_order.groupby(["Month Name", "MonthOrder"]).size().reset_index(name="Count")
-            month_data = month_data.sort_values("MonthOrder")
+            # Make chart interactive
+            selected_points = plotly_chart(fig, key="detailed_categories_chart", use_container_width=True)
         
+            # Process clicks on the chart
+            if selected_points:
+                selected_category = detailed_categories.iloc[selected_points["points"][0]["pointIndex"]]["Category"]
+                st.session_state.selected_filter = ("Detailed Recall Category", selected_category)
+                st.rerun()
+
+    # Monthly breakdown chart (NEW)
+    st.subheader("Monthly Analysis")
+
+    # Create a monthly breakdown chart
+    if aggregates["months"] is not None:
+        # Recalls per month, already sorted by month order
+        month_data = aggregates["months"]
+    
+        def build_figure():
             fig = px.bar(
                 month_data, 
                 x="Month Name", 
                 y="Count",
                 color="Count",
                 color_continuous_scale="Teal",
-                title="Recalls by Month",
-                category_orders={"Month Name": [m for m in all_months if m in month_data["Month Name"].values]}
+                title="Recalls by Month"
             )
             fig.update_layout(height=400)
-            st.plotly_chart(fig, use_container_width=True)
-    
-        # Second row of visualizations
-        viz_col3, viz_col4 = st.columns(2)
-    
-        with viz_col3:
-            # Time series of recalls by month/year
-            if "Year" in filtered_data.columns and "Month Name" in filtered_data.columns:
-                # Prepare time series data
-                filtered_data_with_order = filtered_data.copy()
-                filtered_data_with_order["MonthOrder"] = filtered_data_with_order["Month Name"].map(month_order)
-            
-                time_data = filtered_data_with_order.groupby(["Year", "Month Name", "MonthOrder"]).size().reset_index(name="Count")
-                time_data = time_data.sort_values(["Year", "MonthOrder"])
-                time_data["Date"] = time_data["Year"].astype(str) + "-" + time_data["MonthOrder"].astype(str).str.zfill(2)
-            
+            return fig
+        fig = cached_figure("monthly_chart", filter_key, build_figure)
+        st.plotly_chart(fig, use_container_width=True)
+
+    # Second row of visualizations
+    viz_col3, viz_col4 = st.columns(2)
+
+    with viz_col3:
+        # Time series of recalls by month/year
+        if aggregates["time_series"] is not None:
+            # Time series of recalls by year and month
+            time_data = aggregates["time_series"]
+        
+            def build_figure():
                 fig = px.line(
                     time_data, 
                     x="Date", 
@@ -543,15 +3067,27 @@ def main():
                     markers=True,
                     title="Recalls Over Time"
                 )
+                # Mark the months where some category series was flagged
+                flagged = time_data[time_data["Period"].isin(anomalies["Period"])]
+                if len(flagged):
+                    fig.add_trace(go.Scatter(
+                        x=flagged["Date"],
+                        y=flagged["Count"],
+                        mode="markers",
+                        name="Flagged month",
+                        marker=dict(color="#e4572e", size=11, symbol="diamond")
+                    ))
                 fig.update_layout(height=400)
-                st.plotly_chart(fig, use_container_width=True)
-    
-        with viz_col4:
-            # Food Categories Distribution
-            if "Food Category" in filtered_data.columns:
-                food_categories = filtered_data["Food Category"].value_counts().head(10).reset_index()
-                food_categories.columns = ["Category", "Count"]
-            
+                return fig
+            fig = cached_figure("time_series_chart", filter_key, build_figure)
+            st.plotly_chart(fig, use_container_width=True)
+
+    with viz_col4:
+        # Food Categories Distribution
+        if aggregates["food_categories"] is not None:
+            food_categories = aggregates["food_categories"]
+        
+            def build_figure():
                 fig = px.pie(
                     food_categories, 
                     values="Count", 
@@ -561,30 +3097,42 @@ def main():
                     color_discrete_sequence=px.colors.qualitative.Pastel
                 )
                 fig.update_layout(height=400)
-            
-                # Make chart interactive
-                selected_points = plotly_chart(fig, key="food_categories_chart", use_container_width=True)
-            
-                # Process clicks on the chart
-                if selected_points:
-                    selected_category = food_categories.iloc[selected_points["points"][0]["pointIndex"]]["Category"]
-                    st.session_state.selected_filter = ("Food Category", selected_category)
-                    st.experimental_rerun()
-    
-        # Third row - geographical distribution and seasonal trends
-        viz_col5, viz_col6 = st.columns(2)
-    
-        with viz_col5:
-            # Seasonal trends
-            if "Season" in filtered_data.columns:
-                season_data = filtered_data["Season"].value_counts().reset_index()
-                season_data.columns = ["Season", "Count"]
-            
-                # Define season order
-                season_order = {"Winter": 1, "Spring": 2, "Summer": 3, "Fall": 4}
-                season_data["Order"] = season_data["Season"].map(season_order)
-                season_data = season_data.sort_values("Order")
-            
+                return fig
+            fig = cached_figure("food_categories_chart", filter_key, build_figure)
+        
+            # Make chart interactive
+            selected_points = plotly_chart(fig, key="food_categories_chart", use_container_width=True)
+        
+            # Process clicks on the chart
+            if selected_points:
+                selected_category = food_categories.iloc[selected_points["points"][0]["pointIndex"]]["Category"]
+                st.session_state.selected_filter = ("Food Category", selected_category)
+                st.rerun()
+
+    # Flagged months per recall category and food category
+    st.subheader("Recall Spikes & Trend Shifts")
+    if anomalies.empty:
+        st.info("No unusual months detected for the selected filters.")
+    else:
+        st.dataframe(
+            anomalies.head(TREND_MAX_ANOMALIES).drop(columns="Period"),
+            hide_index=True,
+            use_container_width=True,
+            column_config={"Month": st.column_config.DateColumn(format="MMM YYYY")}
+        )
+    st.caption(f"Spikes are months at least {TREND_Z_THRESHOLD:g} standard deviations above the trailing "
+               f"{TREND_BASELINE_MONTHS}-month mean. Shifts compare the {TREND_SHIFT_MONTHS} months before and after a month.")
+
+    # Third row - geographical distribution and seasonal trends
+    viz_col5, viz_col6 = st.columns(2)
+
+    with viz_col5:
+        # Seasonal trends
+        if aggregates["seasons"] is not None:
+            # Season counts, already in calendar order
+            season_data = aggregates["seasons"]
+        
+            def build_figure():
                 fig = px.bar(
                     season_data, 
                     x="Season", 
@@ -594,14 +3142,16 @@ def main():
                     title="Recalls by Season"
                 )
                 fig.update_layout(height=350)
-                st.plotly_chart(fig, use_container_width=True)
-    
-        with viz_col6:
-            # Company Size breakdown
-            if "Company Size" in filtered_data.columns:
-                company_size = filtered_data["Company Size"].value_counts().reset_index()
-                company_size.columns = ["Size", "Count"]
-            
+                return fig
+            fig = cached_figure("seasons_chart", filter_key, build_figure)
+            st.plotly_chart(fig, use_container_width=True)
+
+    with viz_col6:
+        # Company Size breakdown
+        if aggregates["company_sizes"] is not None:
+            company_size = aggregates["company_sizes"]
+        
+            def build_figure():
                 fig = px.pie(
                     company_size, 
                     values="Count", 
@@ -610,272 +3160,333 @@ def main():
                     color_discrete_sequence=px.colors.qualitative.Bold
                 )
                 fig.update_layout(height=350)
-                st.plotly_chart(fig, use_container_width=True)
-    
-        # Data table with search functionality
-        st.subheader("Recent Recalls")
+                return fig
+            fig = cached_figure("company_sizes_chart", filter_key, build_figure)
+            st.plotly_chart(fig, use_container_width=True)
+
+    # The table reruns on its own when its search box or paging changes
+    render_recent_recalls(backend, selected_filters)
+
+# Recent Recalls table with search and paging; its widgets rerun only this fragment
+@st.fragment
+def render_recent_recalls(backend, selected_filters):
+    # Data table with search functionality
+    st.subheader("Recent Recalls")
+
+    search_term = st.text_input("Search recalls", "")
+
+    # Select the most relevant columns for display
+    display_columns = ["Recalling Firm Name", "Product Description", "Reason for Recall", 
+                      "Food Category", "Center Classification Date", "Status"]
+
+    display_columns = [col for col in display_columns if col in backend.columns]
+
+    # Page through the results, most recent first; only the rows on the page are fetched
+    total_rows = backend.count(selected_filters, search_term)
+    page_col1, page_col2 = st.columns([1, 3])
+    with page_col1:
+        page_size = st.selectbox("Rows per page", RECENT_PAGE_SIZES, index=1)
+    page_count = max(1, -(-total_rows // page_size))
+    with page_col2:
+        # Keyed by filter and search state so the table goes back to page 1 when they change
+        page_key = filter_state_key({**selected_filters, "search": [search_term]}, backend.version)[:16]
+        page = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1, key=f"recent_page_{page_key}")
+    offset = (page - 1) * page_size
+    page_rows = backend.page(selected_filters, search_term, offset, page_size, display_columns)
+
+    st.dataframe(page_rows, use_container_width=True)
+    if total_rows:
+        st.caption(f"Showing {offset + 1:,}-{offset + len(page_rows):,} of {total_rows:,} recalls")
+    else:
+        st.caption("No recalls match the current filters.")
+
+# Ask Contamio chat; sending a message reruns only this fragment
+@st.fragment
+def render_chat(df):
+    # Configure the container for proper spacing
+    st.markdown("""
+    <style>
+        /* One row per message, aligned by role */
+        .message-row {
+            display: flex;
+            flex-direction: column;
+        }
+        
+        /* Message styling */
+        .message {
+            margin: 8px 15px;
+            max-width: 75%;
+            padding: 10px 15px;
+            border-radius: 15px;
+            position: relative;
+            word-wrap: break-word;
+        }
+        
+        .user {
+            background-color: white;
+            align-self: flex-end;
+            border-top-right-radius: 5px;
+        }
+        
+        .assistant {
+            background-color: #e3f2fd;
+            align-self: flex-start;
+            border-top-left-radius: 5px;
+        }
+        
+        /* Input area styling */
+        .input-area {
+            display: flex;
+            padding: 10px;
+            background-color: white;
+            border-radius: 20px;
+            margin-top: 10px;
+        }
+        
+        /* Remove default Streamlit element spacing */
+        div.block-container {padding-top: 0; padding-bottom: 0;}
+        div[data-testid="stVerticalBlock"] > div {padding: 0 !important;}
+    </style>
+    """, unsafe_allow_html=True)
     
-        search_term = st.text_input("Search recalls", "")
+    # Initialize session state
+    if "messages" not in st.session_state:
+        st.session_state.messages = [
+            {"role": "assistant", "content": "Hello, welcome to Contamio! We're dedicated to enhancing food safety and optimizing HACCP programs through innovative technology. How can we help you today?"}
+        ]
     
-        if search_term:
-            search_results = filtered_data[
-                filtered_data["Product Description"].str.contains(search_term, case=False, na=False) |
-                filtered_data["Recalling Firm Name"].str.contains(search_term, case=False, na=False) |
-                filtered_data["Reason for Recall"].str.contains(search_term, case=False, na=False)
-            ]
-            display_data = search_results
-        else:
-            display_data = filtered_data
+    if "thinking" not in st.session_state:
+        st.session_state.thinking = False
+        
+    if "user_message_sent" not in st.session_state:
+        st.session_state.user_message_sent = False
     
-        # Select the most relevant columns for display
-        display_columns = ["Recalling Firm Name", "Product Description", "Reason for Recall", 
-                          "Food Category", "Center Classification Date", "Status"]
+    # Header
+    st.markdown("""
+    <div style="background-color: #00a3e0; color: white; padding: 10px 15px; display: flex; align-items: center; border-radius: 10px 10px 0 0;">
+        <img src="data:image/svg+xml;base64,PHN2ZyB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciIHZpZXdCb3g9IjAgMCA0MDAgMzAwIj48Y2lyY2xlIGN4PSIyMDAiIGN5PSIxNTAiIHI9IjEyMCIgZmlsbD0ibm9uZSIvPjxjaXJjbGUgY3g9IjIwMCIgY3k9IjE1MCIgcj0iMjAiIGZpbGw9IiNmZmZmZmYiLz48Y2lyY2xlIGN4PSIxMjAiIGN5PSIxNTAiIHI9IjE1IiBmaWxsPSIjZmZmZmZmIi8+PGNpcmNsZSBjeD0iMjgwIiBjeT0iMTUwIiByPSIxNSIgZmlsbD0iI2ZmZmZmZiIvPjxjaXJjbGUgY3g9IjE0MCIgY3k9IjkwIiByPSIxMCIgZmlsbD0iI2ZmZmZmZiIvPjxjaXJjbGUgY3g9IjI2MCIgY3k9IjkwIiByPSIxMCIgZmlsbD0iI2ZmZmZmZiIvPjxjaXJjbGUgY3g9IjE0MCIgY3k9IjIxMCIgcj0iMTAiIGZpbGw9IiNmZmZmZmYiLz48Y2lyY2xlIGN4PSIyNjAiIGN5PSIyMTAiIHI9IjEwIiBmaWxsPSIjZmZmZmZmIi8+PGNpcmNsZSBjeD0iMTcwIiBjeT0iNzAiIHI9IjgiIGZpbGw9IiNmZmZmZmYiLz48Y2lyY2xlIGN4PSIyMzAiIGN5PSI3MCIgcj0iOCIgZmlsbD0iI2ZmZmZmZiIvPjxjaXJjbGUgY3g9IjE3MCIgY3k9IjIzMCIgcj0iOCIgZmlsbD0iI2ZmZmZmZiIvPjxjaXJjbGUgY3g9IjIzMCIgY3k9IjIzMCIgcj0iOCIgZmlsbD0iI2ZmZmZmZiIvPjxjaXJjbGUgY3g9IjIwMCIgY3k9IjUwIiByPSIxMiIgZmlsbD0iI2ZmZmZmZiIvPjxjaXJjbGUgY3g9IjIwMCIgY3k9IjI1MCIgcj0iMTIiIGZpbGw9IiNmZmZmZmYiLz48Y2lyY2xlIGN4PSIxMDAiIGN5PSIxMTAiIHI9IjYiIGZpbGw9IiNmZmZmZmYiLz48Y2lyY2xlIGN4PSIzMDAiIGN5PSIxMTAiIHI9IjYiIGZpbGw9IiNmZmZmZmYiLz48Y2lyY2xlIGN4PSIxMDAiIGN5PSIxOTAiIHI9IjYiIGZpbGw9IiNmZmZmZmYiLz48Y2lyY2xlIGN4PSIzMDAiIGN5PSIxOTAiIHI9IjYiIGZpbGw9IiNmZmZmZmYiLz48L3N2Zz4=" width="40" height="40" style="margin-right: 15px;">
+        <div>
+            <h3 style="margin: 0; font-size: 18px;">Contamio</h3>
+            <p style="margin: 0; font-size: 14px; opacity: 0.8;">Food Safety Assistant</p>
+        </div>
+    </div>
+    """, unsafe_allow_html=True)
     
-        display_columns = [col for col in display_columns if col in display_data.columns]
+    # Chat messages area: one element per message, so streaming an answer only updates its own element
+    with st.container(height=480):
+        # Turns moved to the chat store are shown again on request, a page at a time
+        earlier_messages = st.session_state.get("earlier_messages", [])
+        # Lowest position shown; with nothing loaded yet, the first in-memory turn
+        earlier_start = st.session_state.get("earlier_start", 0) if earlier_messages else st.session_state.get("messages_offset", 0)
+        room = CHAT_MAX_EARLIER_MESSAGES - len(earlier_messages)
+        if earlier_start > 0 and room > 0:
+            if st.button("Load earlier messages", key="load_earlier_messages"):
+                page = get_chat_store().load(st.session_state.chat_session_id, earlier_start, min(CHAT_LOAD_PAGE_SIZE, room))
+                earlier_messages = page + earlier_messages
+                st.session_state.earlier_messages = earlier_messages
+                st.session_state.earlier_start = earlier_start - len(page)
+        elif earlier_start > 0:
+            st.caption("Older messages aren't shown.")
+        
+        for message in earlier_messages + st.session_state.messages:
+            st.markdown(message_html(message), unsafe_allow_html=True)
+        
+        response_placeholder = st.empty()
     
-        # Show most recent recalls first
-        if "Center Classification Date" in display_data.columns:
-            display_data = display_data.sort_values("Center Classification Date", ascending=False)
+    # Show thinking indicator if processing
+    if st.session_state.get("thinking", False):
+        response_placeholder.markdown(
+            '<div class="message-row assistant"><div class="message assistant" style="background-color: #e8eaf6;">Analyzing food recall data...</div></div>',
+            unsafe_allow_html=True
+        )
     
-        # Show only a limited number of rows to avoid overwhelming the UI
-        st.dataframe(display_data[display_columns].head(50), use_container_width=True)
+    # Use a form to prevent automatic resubmission
+    with st.form(key="chat_form", clear_on_submit=True):
+        # Input area
+        col1, col2 = st.columns([5, 1])
+        with col1:
+            user_input = st.text_input("", placeholder="Type a message...", key="user_input", label_visibility="collapsed")
+        with col2:
+            send_button = st.form_submit_button("Send", disabled=st.session_state.get("thinking", False))
     
-
-
-     # Ask Contamio Tab
-    with tabs[1]:
-        # Configure the container for proper spacing
-        st.markdown("""
-        <style>
-            /* Basic container styling */
-            .chat-area {
-                background-color: #f0f2f5;
-                border-radius: 10px;
-                height: 480px;
-                margin-bottom: 10px;
-                overflow-y: auto;
-                display: flex;
-                flex-direction: column;
-            }
-            
-            /* Message styling */
-            .message {
-                margin: 8px 15px;
-                max-width: 75%;
-                padding: 10px 15px;
-                border-radius: 15px;
-                position: relative;
-                word-wrap: break-word;
-            }
-            
-            .user {
-                background-color: white;
-                align-self: flex-end;
-                border-top-right-radius: 5px;
-            }
-            
-            .assistant {
-                background-color: #e3f2fd;
-                align-self: flex-start;
-                border-top-left-radius: 5px;
-            }
-            
-            /* Input area styling */
-            .input-area {
-                display: flex;
-                padding: 10px;
-                background-color: white;
-                border-radius: 20px;
-                margin-top: 10px;
-            }
-            
-            /* Remove default Streamlit element spacing */
-            div.block-container {padding-top: 0; padding-bottom: 0;}
-            div[data-testid="stVerticalBlock"] > div {padding: 0 !important;}
-        </style>
-        """, unsafe_allow_html=True)
+    # Process user input - only when form is submitted
+    if send_button and user_input and not st.session_state.get("thinking", False):
+        # Add user message to chat history
+        st.session_state.messages.append({"role": "user", "content": user_input})
         
-        # Initialize session state
-        if "messages" not in st.session_state:
-            st.session_state.messages = [
-                {"role": "assistant", "content": "Hello, welcome to Contamio! We're dedicated to enhancing food safety and optimizing HACCP programs through innovative technology. How can we help you today?"}
-            ]
+        # Set thinking state
+        st.session_state.thinking = True
         
-        if "thinking" not in st.session_state:
-            st.session_state.thinking = False
-            
-        if "user_message_sent" not in st.session_state:
-            st.session_state.user_message_sent = False
-        
-        # Header
-        st.markdown("""
-        <div style="background-color: #00a3e0; color: white; padding: 10px 15px; display: flex; align-items: center; border-radius: 10px 10px 0 0;">
-            <img src="data:image/svg+xml;base64,PHN2ZyB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciIHZpZXdCb3g9IjAgMCA0MDAgMzAwIj48Y2lyY2xlIGN4PSIyMDAiIGN5PSIxNTAiIHI9IjEyMCIgZmlsbD0ibm9uZSIvPjxjaXJjbGUgY3g9IjIwMCIgY3k9IjE1MCIgcj0iMjAiIGZpbGw9IiNmZmZmZmYiLz48Y2lyY2xlIGN4PSIxMjAiIGN5PSIxNTAiIHI9IjE1IiBmaWxsPSIjZmZmZmZmIi8+PGNpcmNsZSBjeD0iMjgwIiBjeT0iMTUwIiByPSIxNSIgZmlsbD0iI2ZmZmZmZiIvPjxjaXJjbGUgY3g9IjE0MCIgY3k9IjkwIiByPSIxMCIgZmlsbD0iI2ZmZmZmZiIvPjxjaXJjbGUgY3g9IjI2MCIgY3k9IjkwIiByPSIxMCIgZmlsbD0iI2ZmZmZmZiIvPjxjaXJjbGUgY3g9IjE0MCIgY3k9IjIxMCIgcj0iMTAiIGZpbGw9IiNmZmZmZmYiLz48Y2lyY2xlIGN4PSIyNjAiIGN5PSIyMTAiIHI9IjEwIiBmaWxsPSIjZmZmZmZmIi8+PGNpcmNsZSBjeD0iMTcwIiBjeT0iNzAiIHI9IjgiIGZpbGw9IiNmZmZmZmYiLz48Y2lyY2xlIGN4PSIyMzAiIGN5PSI3MCIgcj0iOCIgZmlsbD0iI2ZmZmZmZiIvPjxjaXJjbGUgY3g9IjE3MCIgY3k9IjIzMCIgcj0iOCIgZmlsbD0iI2ZmZmZmZiIvPjxjaXJjbGUgY3g9IjIzMCIgY3k9IjIzMCIgcj0iOCIgZmlsbD0iI2ZmZmZmZiIvPjxjaXJjbGUgY3g9IjIwMCIgY3k9IjUwIiByPSIxMiIgZmlsbD0iI2ZmZmZmZiIvPjxjaXJjbGUgY3g9IjIwMCIgY3k9IjI1MCIgcj0iMTIiIGZpbGw9IiNmZmZmZmYiLz48Y2lyY2xlIGN4PSIxMDAiIGN5PSIxMTAiIHI9IjYiIGZpbGw9IiNmZmZmZmYiLz48Y2lyY2xlIGN4PSIzMDAiIGN5PSIxMTAiIHI9IjYiIGZpbGw9IiNmZmZmZmYiLz48Y2lyY2xlIGN4PSIxMDAiIGN5PSIxOTAiIHI9IjYiIGZpbGw9IiNmZmZmZmYiLz48Y2lyY2xlIGN4PSIzMDAiIGN5PSIxOTAiIHI9IjYiIGZpbGw9IiNmZmZmZmYiLz48L3N2Zz4=" width="40" height="40" style="margin-right: 15px;">
-            <div>
-                <h3 style="margin: 0; font-size: 18px;">Contamio</h3>
-                <p style="margin: 0; font-size: 14px; opacity: 0.8;">Food Safety Assistant</p>
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
+        # Rerun to update UI with user message and thinking state
+        rerun_fragment()
         
-        # Chat messages area
-        chat_placeholder = st.empty()
+    # Process thinking state
+    if st.session_state.get("thinking", False):
+        # Get the last user message
+        user_message = st.session_state.messages[-1]["content"]
         
-        # Display messages
-        messages_html = '<div class="chat-area">'
+        # Format conversation history for Claude (the latest user message is sent as the prompt)
+        claude_messages = [
+            {"role": msg["role"], "content": msg["content"]} 
+            for msg in st.session_state.messages[:-1]
+        ]
         
-        for message in st.session_state.messages:
-            role_class = "user" if message["role"] == "user" else "assistant"
-            messages_html += f'<div class="message {role_class}">{message["content"]}</div>'
-            
-        # Show thinking indicator if processing
-        if st.session_state.get("thinking", False):
-            messages_html += '<div class="message assistant" style="background-color: #e8eaf6;">Analyzing food recall data...</div>'
-            
-        messages_html += '</div>'
-        chat_placeholder.markdown(messages_html, unsafe_allow_html=True)
-        
-        # Use a form to prevent automatic resubmission
-        with st.form(key="chat_form", clear_on_submit=True):
-            # Input area
-            col1, col2 = st.columns([5, 1])
-            with col1:
-                user_input = st.text_input("", placeholder="Type a message...", key="user_input", label_visibility="collapsed")
-            with col2:
-                send_button = st.form_submit_button("Send", disabled=st.session_state.get("thinking", False))
-        
-        # Process user input - only when form is submitted
-        if send_button and user_input and not st.session_state.get("thinking", False):
-            # Add user message to chat history
-            st.session_state.messages.append({"role": "user", "content": user_input})
-            
-            # Set thinking state
-            st.session_state.thinking = True
-            
-            # Rerun to update UI with user message and thinking state
-            st.rerun()
-            
-        # Process thinking state
-        if st.session_state.get("thinking", False):
-            # Get the last user message
-            user_message = st.session_state.messages[-1]["content"]
-            
-            # Format conversation history for Claude
-            claude_messages = [
-                {"role": msg["role"], "content": msg["content"]} 
-                for msg in st.session_state.messages
-            ]
-            
-            # Prepare system prompt
-            system_prompt = f"""
-            You are Contamio, a real-time data-driven food risk analyst.
-            Primary purpose: Provide concise, data-focused insights for dynamic HACCP decision-making.
-            
-            Response guidelines:
-            1. Keep responses brief and direct - prioritize facts over explanations
-            2. Lead with specific numbers, percentages, and statistical findings
-            3. Integrate testing recommendations naturally within your points
-            4. Focus only on actionable insights that inform immediate testing decisions
-
-
-            DATABASE CONTEXT:
-            - You have access to a food recall database with {len(df)} records.
-            - The database includes information about product types, companies, recall reasons, and dates.
-            - Top food categories: {', '.join(df['Food Category'].value_counts().head(5).index.tolist())}
-            - Common recall reasons: {', '.join(df['Recall Category'].value_counts().head(5).index.tolist())}
-            - Years covered: {df['Year'].min()} to {df['Year'].max()}
-            - Most frequent contaminants: {', '.join(df[df['Recall Category'] == 'Microbial Contamination']['Detailed Recall Category'].value_counts().head(3).index.tolist()) if 'Microbial Contamination' in df['Recall Category'].values else 'varies'}
-            - Seasonal patterns: {df['Season'].value_counts().index[0]} shows highest recall rates
-            - Top allergens: {', '.join(df[df['Recall Category'] == 'Allergen Issues']['Detailed Recall Category'].value_counts().head(3).index.tolist()) if 'Allergen Issues' in df['Recall Category'].values else 'varies'}
-
-
-            
-            Response format:
-            * Bold headline summarizing key risk (3-5 words)
-            * 2-3 concise bullet points with specific data
-            * Integrate testing priorities directly into relevant points
-            * Total response should be under 10 lines when possible
-
-             Analytical focus:
-             - Highlight seasonal variations relevant to current time period
-             - Identify correlations between product types and specific contaminants
-             - Prioritize Class I (severe) recall risks over less critical issues
-             - Connect data points to specific testing recommendations
-              If the user writes in Hebrew, reply in Hebrew. Otherwise, reply in English.
-              """
-            
-            # Query Claude with enhanced prompt
-            response = query_claude(user_message, claude_messages[-10:], system_prompt)
-            
-            # Add response to message history
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": response
-            })
-            
-            # Turn off thinking state
-            st.session_state.thinking = False
-            
-            # Rerun to update the UI
-            st.rerun()
-            
-        # Add JavaScript to scroll chat to bottom
-        st.markdown("""
-        <script>
-            function scrollChatToBottom() {
-                const chatArea = document.querySelector('.chat-area');
-                if (chatArea) {
-                    chatArea.scrollTop = chatArea.scrollHeight;
-                }
-            }
-            window.addEventListener('load', scrollChatToBottom);
-            const observer = new MutationObserver(scrollChatToBottom);
-            const chatArea = document.querySelector('.chat-area');
-            if (chatArea) {
-                observer.observe(chatArea, { childList: true, subtree: true });
-            }
-        </script>
-        """, unsafe_allow_html=True)
-    # Insights Tab
-    with tabs[2]:
-        st.header("Food Recall Insights")
+        # Turns beyond the history token budget are folded into a rolling memory
+        claude_messages, chat_memory = compact_conversation(claude_messages, df.attrs.get("dataset_version"))
         
-        insight_type = st.selectbox(
-            "Select an insight type:",
-            ["Overall Analysis", "Recall Trends", "Allergen Analysis", "Contaminant Analysis", "Economic Impact"]
-        )
+        # System prompt with the database context, built once per dataset version
+        system_prompt = build_chat_system_prompt(df, df.attrs.get("dataset_version"))
         
-        aspect_mapping = {
-            "Overall Analysis": "overall",
-            "Recall Trends": "trends",
-            "Allergen Analysis": "allergens",
-            "Contaminant Analysis": "contaminants",
-            "Economic Impact": "economic"
-        }
+        # Stream the answer into the chat area as it arrives, redrawing at most every 50 ms
+        streamed_parts = []
+        last_draw = [0.0]
         
-        if st.button("Generate Insights"):
-            with st.spinner("Analyzing data and generating insights..."):
-                insights = generate_insights(df, aspect_mapping[insight_type])
-                st.markdown(insights)
-    
-    # About Tab
-    with tabs[3]:
-        st.header("About Contamio")
+        def show_partial_response(text):
+            streamed_parts.append(text)
+            now = time.monotonic()
+            if now - last_draw[0] >= 0.05:
+                last_draw[0] = now
+                response_placeholder.markdown(
+                    f'<div class="message-row assistant"><div class="message assistant">{"".join(streamed_parts)}</div></div>',
+                    unsafe_allow_html=True
+                )
         
-        st.markdown("""
-        **Contamio** is a food safety analysis platform focused on helping consumers and professionals understand food recall trends and risks.
+        # Query Claude with enhanced prompt
+        response = query_claude(
+            user_message, claude_messages, system_prompt,
+            dataset_version=df.attrs.get("dataset_version"),
+            on_text=show_partial_response,
+            context_blocks=[
+                f"CONVERSATION MEMORY (summary of earlier turns):\n{chat_memory}" if chat_memory else "",
+                build_retrieval_context(df, get_retrieval_index(df, df.attrs.get("dataset_version")), user_message)
+            ],
+            tools=build_chat_tools(df, df.attrs.get("dataset_version")),
+            run_tool=lambda name, params: run_chat_tool(df, df.attrs.get("dataset_version"), name, params)
+        )
+        
+        # Add response to message history
+        st.session_state.messages.append({
+            "role": "assistant",
+            "content": response
+        })
+        
+        # Turn off thinking state
+        st.session_state.thinking = False
         
-        ### Data Source
-        The data used in this application comes from official food recall records in the United States.
+        # Keep the in-memory history bounded
+        spill_chat_history()
         
-        ### Features
-        - **Dashboard**: Visualize food recall trends and patterns
-        - **Chat**: Ask questions about food recalls and get AI-powered answers
-        - **Insights**: Generate in-depth analysis of recall data
+        # Rerun to update the UI
+        rerun_fragment()
+
+# Insights for the selected aspect; its buttons rerun only this fragment
+@st.fragment
+def render_insights(df):
+    dataset_version = df.attrs.get("dataset_version")
+    
+    st.header("Food Recall Insights")
+    
+    insight_type = st.selectbox(
+        "Select an insight type:",
+        list(INSIGHT_ASPECTS)
+    )
+    aspect = INSIGHT_ASPECTS[insight_type]
+    
+    # All aspects are generated in the background; show whatever is ready
+    insights_runner = get_insights_runner()
+    insight = insights_runner.get(dataset_version, aspect)
+    pending = insights_runner.future(dataset_version, aspect)
+    
+    col1, col2 = st.columns([1, 1])
+    with col1:
+        generate_clicked = st.button("Generate Insights", disabled=insight is not None and not insight["error"])
+    with col2:
+        refresh_clicked = st.button("Refresh in background", disabled=pending is not None)
+    
+    if refresh_clicked:
+        insights_runner.refresh(df, [aspect])
+        st.info("Refreshing these insights in the background. The current version stays visible until the new one is ready.")
+    elif generate_clicked and insight is None and pending is not None:
+        # Wait for the background job rather than starting a duplicate request
+        with st.spinner("Analyzing data and generating insights..."):
+            pending.result()
+        insight = insights_runner.get(dataset_version, aspect)
+    elif generate_clicked:
+        future = insights_runner.refresh(df, [aspect])[aspect]
+        with st.spinner("Analyzing data and generating insights..."):
+            future.result()
+        insight = insights_runner.get(dataset_version, aspect)
+    
+    if insight is not None:
+        st.markdown(insight["text"])
+        st.caption(f"Generated {insight['generated_at']:%Y-%m-%d %H:%M}")
+    elif pending is not None:
+        st.info("These insights are being generated in the background. Click Generate Insights to wait for them.")
+
+# Static description of the app
+def render_about():
+    st.header("About Contamio")
+    
+    st.markdown("""
+    **Contamio** is a food safety analysis platform focused on helping consumers and professionals understand food recall trends and risks.
+    
+    ### Data Source
+    The data used in this application comes from official food recall records in the United States.
+    New recall batches (Excel, CSV or openFDA JSON) placed in the `incoming` folder are added automatically.
+    
+    ### Features
+    - **Dashboard**: Visualize food recall trends and patterns
+    - **Chat**: Ask questions about food recalls and get AI-powered answers
+    - **Insights**: Generate in-depth analysis of recall data
+    
+    ### How It Works
+    Contamio uses Claude AI to analyze food recall data and generate insights. The platform helps identify patterns in food recalls, allowing for better understanding of food safety risks.
+    """)
+
+# Main application
+def main():
+    display_logo()
+    
+    # Load the dashboard backend
+    backend = load_backend()
+    
+    if backend is None:
+        st.warning("No data loaded. Please check your Excel file.")
+        return
         
-        ### How It Works
-        Contamio uses Claude AI to analyze food recall data and generate insights. The platform helps identify patterns in food recalls, allowing for better understanding of food safety risks.
-        """)
+    # Sidebar filters live outside the fragments, so changing one reruns the whole page
+    selected_filters = render_filters(backend)
+    
+    # Only the active section is rendered; the others cost nothing until selected
+    section = st.radio(
+        "Section",
+        ["📊 Dashboard", "💬 Ask Contamio", "📈 Insights", "ℹ️ About"],
+        horizontal=True,
+        label_visibility="collapsed",
+        key="active_section"
+    )
+    
+    # Chat and insights work on the in-memory frame. The pandas backend already holds it;
+    # with the SQL backend it is loaded only once one of those sections is opened
+    df = backend.frame
+    if df is None and section in ("💬 Ask Contamio", "📈 Insights"):
+        df = load_data()
+        if df.empty:
+            st.warning("No data loaded. Please check your Excel file.")
+            return
+    
+    # Precompute every Insights aspect in the background the first time this dataset version is seen
+    if df is not None:
+        get_insights_runner().ensure(df)
+    
+    if section == "📊 Dashboard":
+        render_dashboard(backend, selected_filters)
+    elif section == "💬 Ask Contamio":
+        render_chat(df)
+    elif section == "📈 Insights":
+        render_insights(df)
+    else:
+        render_about()
 
 # Run the app
 if __name__ == "__main__":
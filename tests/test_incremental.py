@@ -0,0 +1,124 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+import app
+
+
+def raw_recalls(start, count, food_categories, dates):
+    return pd.DataFrame({
+        "Recall Number": [f"F-{i:05d}" for i in range(start, start + count)],
+        "Recalling Firm Name": [f"Firm {i % 7}" for i in range(start, start + count)],
+        "Product Description": [f"Product {i}" for i in range(start, start + count)],
+        "Reason for Recall": ["Potential Listeria"] * count,
+        "Food Category": [food_categories[i % len(food_categories)] for i in range(count)],
+        "Recall Category": [["Microbial Contamination", "Allergen Issues"][i % 2] for i in range(count)],
+        "Detailed Recall Category": [["Listeria", "Peanut", None][i % 3] for i in range(count)],
+        "Center Classification Date": [dates[i % len(dates)] for i in range(count)],
+        "Company Size": [["Small", "Large"][i % 2] for i in range(count)],
+        "Distribution Pattern": [["CA, NV", "Nationwide", None][i % 3] for i in range(count)]
+    })
+
+
+# A base frame plus appended rows that bring missing dates (so a missing Year) and new categories
+def base_and_appended():
+    base = app.prepare_frame(raw_recalls(0, 60, ["Dairy", "Meat"], ["2019-01-15", "2019-06-02", "2020-03-09"]))
+    rows = app.prepare_frame(raw_recalls(60, 12, ["Dairy", "Beverages"], ["2021-11-30", None, "not a date"]))
+    return base, app.append_rows(base, rows)
+
+
+def test_append_rows_keeps_dtypes_and_values():
+    base, combined = base_and_appended()
+    assert len(combined) == 72
+    # Categoricals gain the new values; every other column keeps its dtype
+    assert combined.dtypes.astype(str).equals(base.dtypes.astype(str))
+    assert combined["Year"].isna().sum() == 8
+    assert "Beverages" in combined["Food Category"].cat.categories
+    assert combined["Month Name"].cat.ordered
+
+
+def test_filter_index_extended_matches_rebuild():
+    base, combined = base_and_appended()
+    extended = app.FilterIndex(base).extended(combined, len(base))
+    rebuilt = app.FilterIndex(combined)
+    assert extended.size == rebuilt.size
+    for col, bitsets in rebuilt.bitsets.items():
+        assert list(extended.bitsets[col]) == list(bitsets)
+        for value, bits in bitsets.items():
+            assert np.array_equal(extended.bitsets[col][value], bits), (col, value)
+    assert np.array_equal(extended.select({"Year": [2021]}), rebuilt.select({"Year": [2021]}))
+
+
+def test_recall_cube_extended_matches_rebuild():
+    base, combined = base_and_appended()
+    extended = app.RecallCube(base).extended(combined, len(base))
+    rebuilt = app.RecallCube(combined)
+    assert extended.labels == rebuilt.labels
+    assert np.array_equal(extended.counts, rebuilt.counts)
+    assert np.array_equal(extended.state_masks, rebuilt.state_masks)
+    for col, (codes, labels) in rebuilt.row_codes.items():
+        assert np.array_equal(extended.row_codes[col][0], codes), col
+        assert extended.row_codes[col][1] == labels
+
+
+def test_search_index_extended_matches_rebuild():
+    base, combined = base_and_appended()
+    # Appended rows repeating earlier documents share their ids instead of adding new ones
+    repeated = app.prepare_frame(raw_recalls(0, 5, ["Dairy"], ["2022-01-01"]))
+    combined = app.append_rows(combined, repeated)
+    extended = app.SearchIndex(base).extended(combined, len(base))
+    rebuilt = app.SearchIndex(combined)
+    for attr in ["order", "starts", "grams", "gram_starts", "gram_docs", "token_starts", "token_docs"]:
+        assert np.array_equal(getattr(extended, attr), getattr(rebuilt, attr)), attr
+    assert extended.tokens == rebuilt.tokens
+    assert extended.docs.tolist() == rebuilt.docs.tolist()
+    for query in ["product 6", "firm 3", "listeria", "pr", "product 1"]:
+        assert np.array_equal(extended.search(query), rebuilt.search(query)), query
+
+def test_refresh_appends_openfda_records_without_dates(tmp_path):
+    source = tmp_path / "recalls.xlsx"
+    raw_recalls(0, 20, ["Dairy"], ["2020-03-09"]).to_excel(source, index=False)
+    incoming = tmp_path / "incoming"
+    incoming.mkdir()
+    store = app.DatasetStore(str(source), str(tmp_path / "cache"), str(incoming), str(tmp_path / "partitions"))
+    before = store.refresh(force=True)
+    before.select({"Year": [2020]})
+    before.get_cube()
+
+    records = [{"recall_number": "J-1", "center_classification_date": ""},
+               {"recall_number": "J-2", "center_classification_date": "20240101"},
+               {"recall_number": "F-00003", "center_classification_date": "20240101"}]
+    (incoming / "batch.json").write_text(json.dumps({"results": records}))
+    after = store.refresh(force=True)
+
+    assert len(after.frame) == 22
+    assert after.version != before.version
+    assert before.frame.attrs["dataset_version"] == before.version
+    assert np.array_equal(after.select({"Year": [2024]}), [21])
+
+
+def test_refresh_appends_pending_partitions_in_one_batch(tmp_path):
+    source = tmp_path / "recalls.xlsx"
+    raw_recalls(0, 20, ["Dairy"], ["2020-03-09"]).to_excel(source, index=False)
+    incoming = tmp_path / "incoming"
+    incoming.mkdir()
+    store = app.DatasetStore(str(source), str(tmp_path / "cache"), str(incoming), str(tmp_path / "partitions"))
+    before = store.refresh(force=True)
+    before.select({"Food Category": ["Dairy"]})
+    before.matching_positions({}, "product")
+
+    raw_recalls(20, 6, ["Beverages"], ["2022-05-01"]).to_csv(incoming / "batch.csv", index=False)
+    records = [{"recall_number": "J-1", "center_classification_date": "20240101"}]
+    (incoming / "batch.json").write_text(json.dumps({"results": records}))
+    after = store.refresh(force=True)
+
+    assert len(after.frame) == 27
+    assert (after.frame.dtypes.astype(str) == before.frame.dtypes.astype(str)).all()
+    rebuilt = app.FilterIndex(after.frame)
+    for col, bitsets in rebuilt.bitsets.items():
+        assert list(after.filter_index.bitsets[col]) == list(bitsets), col
+        for value, bits in bitsets.items():
+            assert np.array_equal(after.filter_index.bitsets[col][value], bits), (col, value)
+    assert after.search_index is not None
+    assert np.array_equal(after.matching_positions({}, "product 2"), app.SearchIndex(after.frame).search("product 2"))